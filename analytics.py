@@ -0,0 +1,278 @@
+import logging
+from collections import defaultdict
+import numpy as np
+from receipt_parser import Receipt, normalize_item
+
+# 1970-01-01 was Thursday, days are shifted by 3 to get Monday based weeks
+WEEK_SHIFT = 3
+
+
+class SpendingAnalytics:
+    """
+    In-memory spending analytics over parsed receipts. Receipts and purchased items are
+    stored in columnar NumPy arrays (day numbers, amounts, item codes and prices), so
+    queries are vectorized group-bys. Weekly and monthly totals are rolled up
+    incrementally as receipts are added.
+    """
+
+    PERIODS = ('day', 'week', 'month')
+
+    def __init__(self, receipts=()):
+        """
+        :param receipts. Parsed receipts (Receipt) loaded initially.
+        """
+        self.log = logging.getLogger('SpendingAnalytics')
+        self.message_ids = set()
+        self.names = list()
+        self.codes = dict()
+        self.item_codes = dict()
+        self.receipt_chunks = list()
+        self.item_chunks = list()
+        self.receipts = (np.empty(0, 'int64'), np.empty(0))
+        self.items = (np.empty(0, 'int64'), np.empty(0, 'int64'), np.empty(0))
+        self.rollups = {period: defaultdict(float) for period in self.PERIODS}
+        self.add(receipts)
+
+    @classmethod
+    def from_cache(cls, cache):
+        """
+        Loads every receipt of receipt cache.
+        :param cache. ReceiptCache.
+        :return SpendingAnalytics.
+        """
+        return cls(Receipt(*receipt) for receipt in cache.receipts())
+
+    @classmethod
+    def from_postgres(cls, db, since=None, until=None):
+        """
+        Loads receipts stored in PostgreSQL.
+        :param db. PostgreSQL.
+        :param since. First date of range (inclusive).
+        :param until. Last date of range (inclusive).
+        :return SpendingAnalytics.
+        """
+        return cls(db.get_receipts(since, until))
+
+    def __amount(self, cost):
+        """
+        Converts receipt cost or item price string (e.g -12,34) to positive number.
+        :param cost. Cost string, None if unknown.
+        :return float. Amount, NaN if unknown.
+        """
+        if cost is None:
+            return np.nan
+        try:
+            return float(cost.lstrip('-').replace(',', '.'))
+        except ValueError:
+            return np.nan
+
+    def __code(self, item):
+        """
+        Gets integer code of normalized item name, new names get next code.
+        Codes are cached by item name, so every distinct name is normalized once.
+        :param item. Item name from receipt.
+        :return int.
+        """
+        code = self.item_codes.get(item)
+        if code is None:
+            name = normalize_item(item).strip()
+            code = self.codes.get(name)
+            if code is None:
+                code = self.codes[name] = len(self.names)
+                self.names.append(name)
+            self.item_codes[item] = code
+        return code
+
+    def __periods(self, days, period):
+        """
+        Converts day numbers to period numbers.
+        :param days. Array of days since 1970-01-01.
+        :param period. 'day', 'week' (number of Monday) or 'month' (months since 1970-01).
+        :return array.
+        """
+        if period == 'day':
+            return days
+        if period == 'week':
+            return days - (days + WEEK_SHIFT) % 7
+        if period == 'month':
+            return days.astype('datetime64[D]').astype('datetime64[M]').astype('int64')
+        raise ValueError(f'Unknown period {period}')
+
+    def __label(self, value, period):
+        """
+        Formats period number as date string (first day of the period).
+        :param value. Period number.
+        :param period. 'day', 'week' or 'month'.
+        :return str. (e.g 2019-11-04 or 2019-11)
+        """
+        return str(np.datetime64(int(value), 'M' if period == 'month' else 'D'))
+
+    def __day(self, date):
+        """
+        Converts date string to day number.
+        :param date. Date (e.g 2019-11-04), None for no limit.
+        :return int.
+        """
+        return None if date is None else int(np.datetime64(date, 'D').astype('int64'))
+
+    def add(self, receipts):
+        """
+        Adds receipts which were not added before (by message id) and updates rollups.
+        :param receipts. Parsed receipts (Receipt).
+        :return int. Number of added receipts.
+        """
+        days, amounts, item_days, item_codes, item_prices = list(), list(), list(), list(), list()
+        for receipt in receipts:
+            if receipt is None or receipt.cost is None:
+                continue
+            if receipt.message_id is not None:
+                if receipt.message_id in self.message_ids:
+                    continue
+                self.message_ids.add(receipt.message_id)
+            day = self.__day(receipt.date)
+            days.append(day)
+            amounts.append(self.__amount(receipt.cost))
+            prices = receipt.prices or [None] * len(receipt.items)
+            for item, price in zip(receipt.items, prices):
+                item_days.append(day)
+                item_codes.append(self.__code(item))
+                item_prices.append(self.__amount(price))
+        if not days:
+            return 0
+        days, amounts = np.array(days, 'int64'), np.array(amounts)
+        self.receipt_chunks.append((days, amounts))
+        self.item_chunks.append((np.array(item_days, 'int64'), np.array(item_codes, 'int64'),
+                                 np.array(item_prices)))
+        for period, rollup in self.rollups.items():
+            periods, inverse = np.unique(self.__periods(days, period), return_inverse=True)
+            for value, total in zip(periods.tolist(), np.bincount(inverse, np.nan_to_num(amounts)).tolist()):
+                rollup[value] += total
+        self.log.debug(f'Added {len(days)} receipts')
+        return len(days)
+
+    def __columns(self):
+        """
+        Concatenates chunks of added receipts into receipt and item columns.
+        :return tuple. Receipt columns (days, amounts) and item columns (days, codes, prices).
+        """
+        if self.receipt_chunks:
+            self.receipts = tuple(np.concatenate(column) for column in
+                                  zip(self.receipts, *self.receipt_chunks))
+            self.items = tuple(np.concatenate(column) for column in zip(self.items, *self.item_chunks))
+            self.receipt_chunks, self.item_chunks = list(), list()
+        return self.receipts, self.items
+
+    def __range(self, days, since, until):
+        """
+        Selects rows of date range.
+        :param days. Array of day numbers.
+        :param since. First date (inclusive), None for no limit.
+        :param until. Last date (inclusive), None for no limit.
+        :return array. Boolean mask.
+        """
+        mask = np.ones(len(days), bool)
+        if since is not None:
+            mask &= days >= self.__day(since)
+        if until is not None:
+            mask &= days <= self.__day(until)
+        return mask
+
+    def totals(self, period='week', since=None, until=None):
+        """
+        Gets spent amount per period from incremental rollup.
+        :param period. 'day', 'week' or 'month'.
+        :param since. First date of range (inclusive), periods overlapping range are included whole.
+        :param until. Last date of range (inclusive).
+        :return list. Tuples of period start (e.g 2019-11-04) and spent amount, ordered by period.
+        """
+        first = None if since is None else self.__periods(np.array([self.__day(since)]), period)[0]
+        last = None if until is None else self.__periods(np.array([self.__day(until)]), period)[0]
+        return [(self.__label(value, period), round(total, 2))
+                for value, total in sorted(self.rollups[period].items())
+                if (first is None or value >= first) and (last is None or value <= last)]
+
+    def __masked_totals(self, days, amounts, period):
+        """
+        Gets spent amount per period of selected receipts, periods at range edges are counted partially.
+        :param days. Array of receipt day numbers.
+        :param amounts. Array of receipt amounts.
+        :param period. 'day', 'week' or 'month'.
+        :return list. Tuples of period start and spent amount, ordered by period.
+        """
+        periods, inverse = np.unique(self.__periods(days, period), return_inverse=True)
+        return [(self.__label(value, period), round(total, 2))
+                for value, total in zip(periods.tolist(), np.bincount(inverse, np.nan_to_num(amounts)).tolist())]
+
+    def item_totals(self, since=None, until=None):
+        """
+        Gets number of purchases and spent amount of every item.
+        :param since. First date of range (inclusive).
+        :param until. Last date of range (inclusive).
+        :return dict. Normalized item name to tuple of purchase count and spent amount.
+        """
+        _, (days, codes, prices) = self.__columns()
+        mask = self.__range(days, since, until)
+        counts = np.bincount(codes[mask], minlength=len(self.names))
+        spent = np.bincount(codes[mask], np.nan_to_num(prices[mask]), minlength=len(self.names))
+        return {self.names[code]: (int(counts[code]), round(float(spent[code]), 2))
+                for code in np.flatnonzero(counts)}
+
+    def top_items(self, n=10, by='spent', since=None, until=None):
+        """
+        Gets items with the largest spent amount or purchase count.
+        :param n. Number of items.
+        :param by. 'spent' or 'count'.
+        :param since. First date of range (inclusive).
+        :param until. Last date of range (inclusive).
+        :return list. Tuples of item name, purchase count and spent amount.
+        """
+        _, (days, codes, prices) = self.__columns()
+        mask = self.__range(days, since, until)
+        counts = np.bincount(codes[mask], minlength=len(self.names))
+        spent = np.bincount(codes[mask], np.nan_to_num(prices[mask]), minlength=len(self.names))
+        values = spent if by == 'spent' else counts
+        top = np.argsort(-values, kind='stable')[:n]
+        return [(self.names[code], int(counts[code]), round(float(spent[code]), 2)) for code in top if counts[code]]
+
+    def price_trend(self, item, period='month', since=None, until=None):
+        """
+        Gets average price of item per period.
+        :param item. Item name (normalized the same way as receipt items).
+        :param period. 'day', 'week' or 'month'.
+        :param since. First date of range (inclusive).
+        :param until. Last date of range (inclusive).
+        :return list. Tuples of period start and average price, ordered by period.
+        """
+        code = self.codes.get(normalize_item(item).strip())
+        if code is None:
+            return list()
+        _, (days, codes, prices) = self.__columns()
+        mask = self.__range(days, since, until) & (codes == code) & ~np.isnan(prices)
+        periods, inverse = np.unique(self.__periods(days[mask], period), return_inverse=True)
+        averages = np.bincount(inverse, prices[mask]) / np.bincount(inverse)
+        return [(self.__label(value, period), round(average, 2))
+                for value, average in zip(periods.tolist(), averages.tolist())]
+
+    def summary(self, since=None, until=None, n=10):
+        """
+        Gets spending summary: receipts count, spent amount, weekly and monthly totals and top items.
+        If range is limited, weekly and monthly totals have only receipts of the range (edge periods
+        are partial), so they add up to spent amount. Otherwise they come from incremental rollups.
+        :param since. First date of range (inclusive).
+        :param until. Last date of range (inclusive).
+        :param n. Number of top items.
+        :return dict.
+        """
+        (days, amounts), _ = self.__columns()
+        mask = self.__range(days, since, until)
+        if since is None and until is None:
+            weeks, months = self.totals('week'), self.totals('month')
+        else:
+            weeks, months = (self.__masked_totals(days[mask], amounts[mask], period) for period in ('week', 'month'))
+        return {
+            'receipts': int(mask.sum()),
+            'spent': round(float(np.nansum(amounts[mask])), 2),
+            'weeks': weeks,
+            'months': months,
+            'top_items': self.top_items(n, since=since, until=until),
+        }
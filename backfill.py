@@ -0,0 +1,104 @@
+import os.path
+import json
+import logging
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from receipt_parser import Receipt, parse_raw_message
+
+
+class Backfill:
+    """
+    Processes every receipt of date range and writes them to month sheets.
+    Progress (including ids of listed messages) is saved after every page of messages,
+    so interrupted backfill continues from the last completed page.
+    """
+
+    def __init__(self, gmail, sheets, since, until, workers=None, checkpoint_file='backfill_checkpoint.json'):
+        """
+        :param gmail. GmailApi instance.
+        :param sheets. SheetsApi instance.
+        :param since. First date of range (e.g 2019-01-01).
+        :param until. Last date of range (inclusive).
+        :param workers. Number of receipt parsing processes, number of CPUs if not provided.
+        :param checkpoint_file. File where backfill progress is stored.
+        """
+        self.log = logging.getLogger('Backfill')
+        self.gmail = gmail
+        self.sheets = sheets
+        self.since = since
+        self.until = until
+        self.workers = workers
+        self.checkpoint_file = checkpoint_file
+
+    def __load_checkpoint(self):
+        """
+        Loads progress of interrupted backfill of the same date range.
+        :return dict. Next page token, number of completed pages, ids of listed messages and whether listing is done.
+        """
+        if os.path.exists(self.checkpoint_file):
+            with open(self.checkpoint_file, 'r') as cf:
+                checkpoint = json.load(cf)
+            if checkpoint['since'] == self.since and checkpoint['until'] == self.until and 'message_ids' in checkpoint:
+                self.log.info(f'Resuming backfill after {checkpoint["pages"]} pages')
+                return checkpoint
+        return {'since': self.since, 'until': self.until, 'page_token': None, 'pages': 0, 'message_ids': [],
+                'listed': False}
+
+    def __save_checkpoint(self, checkpoint):
+        """
+        Saves backfill progress.
+        :param checkpoint. Dictionary with backfill progress.
+        :return nothing.
+        """
+        with open(self.checkpoint_file, 'w') as cf:
+            json.dump(checkpoint, cf)
+
+    def __query(self):
+        """
+        Builds Gmail search query of date range. Gmail before: is exclusive.
+        :return str. Gmail search query.
+        """
+        until = datetime.strptime(self.until, '%Y-%m-%d') + timedelta(days=1)
+        return f'after:{self.since.replace("-", "/")} before:{until:%Y/%m/%d}'
+
+    def __process_page(self, messages, executor):
+        """
+        Downloads messages which are not in receipt cache batch by batch, parses every batch
+        in process pool and stores parsed receipts to receipt cache.
+        :param messages. List of messages of one page.
+        :param executor. Process pool used for parsing.
+        :return nothing.
+        """
+        cached = self.gmail.cache.get_many(message['id'] for message in messages)
+        parse = partial(parse_raw_message, sender=self.gmail.SENDER)
+        for raw_messages in self.gmail.iter_batches([message for message in messages if message['id'] not in cached]):
+            receipts = executor.map(parse, raw_messages, chunksize=4)
+            self.gmail.cache.put_many({msg['id']: receipt for msg, receipt in zip(raw_messages, receipts)})
+
+    def run(self):
+        """
+        Lists every receipt message of date range page by page, processes each page
+        and saves checkpoint. When listing is completed, receipts of listed messages are
+        taken from receipt cache and written to sheets.
+        :return int. Number of written receipts.
+        """
+        checkpoint = self.__load_checkpoint()
+        query = self.__query()
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            while not checkpoint['listed']:
+                messages, page_token = self.gmail.list_page(query, checkpoint['page_token'])
+                self.__process_page(messages, executor)
+                checkpoint['message_ids'].extend(message['id'] for message in messages)
+                checkpoint.update(page_token=page_token, pages=checkpoint['pages'] + 1, listed=page_token is None)
+                self.__save_checkpoint(checkpoint)
+                self.log.info(f'Processed page {checkpoint["pages"]} ({len(messages)} messages)')
+
+        cached = self.gmail.cache.get_many(checkpoint['message_ids'])
+        receipts = [receipt for receipt in (Receipt(*cached[message_id]) for message_id in checkpoint['message_ids']
+                                            if cached.get(message_id) is not None)
+                    if self.since <= receipt.date <= self.until]
+        self.sheets.write_history(receipts)
+        os.remove(self.checkpoint_file)
+        self.log.info(f'Backfill completed! Written {len(receipts)} receipts')
+        return len(receipts)
@@ -0,0 +1,369 @@
+import os
+import json
+import shutil
+import random
+import tempfile
+import statistics
+import time
+import tracemalloc
+import urllib.request
+from datetime import date, timedelta
+from receipt_parser import Receipt, parse_receipt, parse_lines
+from fake_google import ITEMS, FakeGoogleProcess, synthetic_receipt
+
+
+def parse_receipt_soup(payload):
+    """
+    Previous receipt parsing path which builds full BeautifulSoup tree.
+    :param payload. HTML part of the email message (str).
+    :return Receipt. Parsed receipt.
+    """
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(payload, 'lxml')
+    receipt_html = soup.findAll(lambda tag: tag.name == 'pre')
+    return parse_lines(str(receipt_html[1]).splitlines()[1:])
+
+
+def measure(parser, corpus):
+    """
+    Parses whole corpus with provided parser, measuring time and memory allocations.
+    Parsed receipts are kept during allocation measurement, so blocks allocated by parsing
+    and held by its results (and parser caches) are counted, temporary ones show up in peak.
+    :param parser. Function which parses receipt HTML.
+    :param corpus. List of receipt HTML parts.
+    :return dict. Per receipt parse time (microseconds), memory blocks allocated by parsing
+    which are still held after it and peak memory of parsing one receipt (KiB).
+    """
+    tracemalloc.start()
+    ignored = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    before = tracemalloc.take_snapshot().filter_traces(ignored)
+    parsed, peak = list(), 0
+    for payload in corpus:
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        parsed.append(parser(payload))
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+    after = tracemalloc.take_snapshot().filter_traces(ignored)
+    tracemalloc.stop()
+    allocated = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+    del parsed
+
+    start = time.perf_counter()
+    for payload in corpus:
+        parser(payload)
+    elapsed = time.perf_counter() - start
+    return {
+        'us_per_receipt': round(elapsed / len(corpus) * 1e6, 1),
+        'held_blocks_per_receipt': round(allocated / len(corpus), 1),
+        'peak_kib_per_receipt': round(peak / 1024, 1),
+    }
+
+
+def bench_parser(receipts=1000):
+    """
+    Compares streaming receipt parser with BeautifulSoup tree parser on synthetic receipts.
+    :param receipts. Number of synthetic receipts in corpus.
+    :return dict. Measurements of both parsers.
+    """
+    random.seed(0)
+    corpus = [synthetic_receipt() for _ in range(receipts)]
+    results = {'scanner': measure(parse_receipt, corpus)}
+    try:
+        results['beautifulsoup'] = measure(parse_receipt_soup, corpus)
+    except ImportError:
+        pass
+    return results
+
+
+def synthetic_receipt_items(count):
+    """
+    Generates parsed receipts with count items in total.
+    :param count. Number of receipt items.
+    :return list. Receipts with message ids.
+    """
+    receipts = list()
+    while count > 0:
+        items = [random.choice(ITEMS) for _ in range(min(count, random.randint(1, 40)))]
+        day = date(2019, 1, 1) + timedelta(days=random.randint(0, 364))
+        prices = [f'{random.randint(0, 20)},{random.randint(0, 99):02d}' for _ in items]
+        receipts.append(Receipt(f'{day:%Y-%m-%d}', f'-{random.randint(1, 200)},{random.randint(0, 99):02d}', items,
+                                f'{len(receipts):016x}', prices))
+        count -= len(items)
+    return receipts
+
+
+def insert_row_by_row(params, receipts):
+    """
+    Previous insert path: new connection, one INSERT statement per item.
+    :param params. Database connection parameters.
+    :param receipts. Parsed receipts.
+    :return nothing.
+    """
+    import psycopg2 as pg2
+    conn = pg2.connect(**params)
+    cur = conn.cursor()
+    cur.execute('CREATE TABLE IF NOT EXISTS payments (date date, amount VARCHAR(20), items VARCHAR(500))')
+    for day, amount, items, *_ in receipts:
+        for item in items:
+            cur.execute(f"""
+            INSERT INTO payments(date, amount, items)
+            VALUES(to_date('{day}', 'YYYY-MM-DD'), {amount.replace(',', '.')}, '{item.lower()}');
+            """)
+    conn.commit()
+    conn.close()
+
+
+def bench_postgres(items=100000, section='postgresql_benchmark'):
+    """
+    Compares row by row inserts with pooled execute_values upserts. Uses separate
+    database configured in database.ini section, its tables are truncated.
+    :param items. Number of receipt items inserted.
+    :param section. database.ini section of benchmark database.
+    :return dict. Inserted rows per second of both insert paths.
+    """
+    from postgre import PostgreSQL
+    random.seed(0)
+    receipts = synthetic_receipt_items(items)
+    db = PostgreSQL(section=section)
+    results = dict()
+    for name, insert in [('row_by_row', lambda: insert_row_by_row(db.params, receipts)),
+                         ('execute_values', lambda: db.insert_receipts(receipts))]:
+        with db.connection() as cur:
+            cur.execute('DROP TABLE IF EXISTS payments; TRUNCATE receipts CASCADE')
+        start = time.perf_counter()
+        insert()
+        results[name] = {'rows_per_second': round(items / (time.perf_counter() - start))}
+    db.close()
+    return results
+
+
+def bench_startup(apis=(('gmail', 'v1'), ('sheets', 'v4'), ('drive', 'v3')), repeat=5):
+    """
+    Compares service client construction with discovery document fetched over network,
+    with bundled discovery document and with ClientManager (new manager, and second and
+    later calls of the same manager). ClientManager is pointed to offline root URL,
+    so no credentials are used and only client construction is measured.
+    :param apis. List of (api, version) pairs which are built.
+    :param repeat. Number of constructions of every client.
+    :return dict. Milliseconds per construction of all clients.
+    """
+    import httplib2
+    from googleapiclient.discovery import build
+    from google_clients import ClientManager
+
+    cached = ClientManager(root_url='http://localhost/')
+    results = dict()
+    for name, builder in [('network_discovery', lambda api, version: build(api, version, http=httplib2.Http(),
+                                                                             static_discovery=False,
+                                                                             cache_discovery=False)),
+                          ('static_discovery', lambda api, version: build(api, version, http=httplib2.Http(),
+                                                                            static_discovery=True,
+                                                                            cache_discovery=False)),
+                          ('client_manager_new', lambda api, version: ClientManager(root_url='http://localhost/')
+                           .service(api, version, 'bench', scopes=[])),
+                          ('client_manager_cached', lambda api, version: cached.service(api, version, 'bench',
+                                                                                        scopes=[]))]:
+        if name == 'client_manager_cached':
+            for api, version in apis:
+                builder(api, version)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for api, version in apis:
+                builder(api, version)
+        results[name] = {'ms_per_startup': round((time.perf_counter() - start) / repeat * 1000, 1)}
+    return results
+
+
+def bench_analytics(sizes=(10000, 100000, 1000000)):
+    """
+    Loads receipts with provided numbers of items to SpendingAnalytics and runs summary queries.
+    :param sizes. Numbers of receipt items.
+    :return dict. Per size load time and median query times (milliseconds).
+    """
+    from analytics import SpendingAnalytics
+
+    results = dict()
+    for size in sizes:
+        receipts = synthetic_receipt_items(size)
+        start = time.perf_counter()
+        analytics = SpendingAnalytics(receipts)
+        load = time.perf_counter() - start
+        queries = {
+            'monthly_totals': lambda: analytics.totals('month'),
+            'item_totals': lambda: analytics.item_totals('2019-03-01', '2019-09-30'),
+            'top_items': lambda: analytics.top_items(5),
+            'price_trend': lambda: analytics.price_trend(ITEMS[0], 'week'),
+        }
+        results[size] = {'load_ms': round(load * 1000, 1)}
+        for name, query in queries.items():
+            query()
+            timings = list()
+            for _ in range(20):
+                start = time.perf_counter()
+                query()
+                timings.append(time.perf_counter() - start)
+            results[size][f'{name}_ms'] = round(statistics.median(timings) * 1000, 2)
+    return results
+
+
+def bench_fetch(sizes=(30, 300, 1000)):
+    """
+    Downloads every message of mailboxes of provided sizes from offline stand-in Gmail API
+    twice: with one messages.get request per message (previous path) and with batch
+    HTTP requests of GmailApi.iter_batches.
+    :param sizes. Numbers of receipt messages in mailbox.
+    :return dict. Per mailbox size and path wall time, HTTP requests and API calls served by stand-in.
+    """
+    from gmail_api import GmailApi
+    from google_clients import ClientManager
+    from request_executor import RequestExecutor
+
+    def stats(server):
+        return json.load(urllib.request.urlopen(server.url + '_stats'))
+
+    results = dict()
+    cwd = os.getcwd()
+    for size in sizes:
+        server = FakeGoogleProcess(size)
+        workdir = tempfile.mkdtemp()
+        os.chdir(workdir)
+        try:
+            unlimited = {api: (1e9, 1e9) for api in RequestExecutor.QUOTAS}
+            clients = ClientManager(executor=RequestExecutor(quotas=unlimited), root_url=server.url)
+            gmail = GmailApi(clients=clients)
+            messages, page_token = gmail.list_page()
+            while page_token is not None:
+                page, page_token = gmail.list_page(page_token=page_token)
+                messages.extend(page)
+
+            def serial():
+                return [clients.executor.execute('gmail', gmail.service.users().messages().get(
+                    userId='me', id=message['id'], format='raw'), cost=5) for message in messages]
+
+            def batch():
+                return [msg for raw_messages in gmail.iter_batches(messages) for msg in raw_messages]
+
+            results[size] = dict()
+            for name, fetch in [('serial', serial), ('batch', batch)]:
+                before = stats(server)
+                start = time.perf_counter()
+                fetched = fetch()
+                wall = time.perf_counter() - start
+                after = stats(server)
+                calls = {call: count - before.get(call, 0) for call, count in after.items()
+                         if count != before.get(call, 0)}
+                results[size][name] = {'messages': len(fetched), 'wall_s': round(wall, 3),
+                                       'http_requests': calls.get('batch', calls.get('gmail.messages.get', 0)),
+                                       'api_calls': calls}
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir)
+            server.stop()
+    return results
+
+
+def bench_streaming(sizes=(30, 1000, 50000)):
+    """
+    Streams receipts of mailboxes of provided sizes through GmailApi.iter_receipts against
+    offline stand-in Google APIs and traces memory. Only message ids and parsed receipts
+    grow with mailbox size, so peak memory per message should stay flat and small
+    compared to raw message size.
+    :param sizes. Numbers of receipt messages in mailbox.
+    :return dict. Per mailbox size receipts count, peak traced memory (MiB) and peak per message (KiB).
+    """
+    from gmail_api import GmailApi
+    from google_clients import ClientManager
+    from request_executor import RequestExecutor
+
+    results = dict()
+    cwd = os.getcwd()
+    for size in sizes:
+        server = FakeGoogleProcess(size)
+        workdir = tempfile.mkdtemp()
+        os.chdir(workdir)
+        try:
+            unlimited = {api: (1e9, 1e9) for api in RequestExecutor.QUOTAS}
+            clients = ClientManager(executor=RequestExecutor(quotas=unlimited), root_url=server.url)
+            gmail = GmailApi(clients=clients)
+            tracemalloc.start()
+            receipts = sum(1 for _ in gmail.iter_receipts())
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[size] = {'receipts': receipts, 'peak_mib': round(peak / 2 ** 20, 1),
+                             'peak_kib_per_message': round(peak / 2 ** 10 / size, 2)}
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir)
+            server.stop()
+    return results
+
+
+def bench_pipeline(sizes=(30, 1000, 100000), use_async=False):
+    """
+    Runs MainApp daily sequence against offline stand-in Google APIs (run in separate process)
+    with mailboxes of provided sizes. Every run starts from empty state in temporary directory.
+    :param sizes. Numbers of receipt messages in mailbox.
+    :param use_async. Run MainApp with asyncio pipeline.
+    :return dict. Per mailbox size wall time, API call counts, client side request
+    latency percentiles (milliseconds) and peak traced memory (MiB).
+    """
+    import httplib2
+    import main
+    from google_clients import ClientManager
+    from request_executor import RequestExecutor
+    from fortune import FortuneCorpus
+
+    latencies = list()
+
+    class TimedHttp(httplib2.Http):
+        def request(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return super().request(*args, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - start)
+
+    results = dict()
+    cwd = os.getcwd()
+    for size in sizes:
+        server = FakeGoogleProcess(size)
+        workdir = tempfile.mkdtemp()
+        os.chdir(workdir)
+        latencies.clear()
+        try:
+            unlimited = {api: (1e9, 1e9) for api in RequestExecutor.QUOTAS}
+            clients = ClientManager(executor=RequestExecutor(quotas=unlimited), root_url=server.url,
+                                    http_class=TimedHttp)
+            fortunes = FortuneCorpus(url=server.url + 'fortunes/{}/')
+            fortunes.sync()
+            tracemalloc.start()
+            start = time.perf_counter()
+            main.MainApp('22:25:00', use_async, clients=clients, fortunes=fortunes).run_once()
+            wall = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+            results[size] = {
+                'wall_s': round(wall, 2),
+                'api_calls': json.load(urllib.request.urlopen(server.url + '_stats')),
+                'requests': len(latencies),
+                'p50_ms': round(percentiles[49] * 1000, 1),
+                'p95_ms': round(percentiles[94] * 1000, 1),
+                'p99_ms': round(percentiles[98] * 1000, 1),
+                'peak_mib': round(peak / 2 ** 20, 1),
+            }
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(workdir)
+            server.stop()
+    return results
+
+
+if __name__ == '__main__':
+    import sys
+    benchmarks = {'parser': bench_parser, 'postgres': bench_postgres, 'startup': bench_startup,
+                  'analytics': bench_analytics, 'fetch': bench_fetch, 'streaming': bench_streaming,
+                  'pipeline': bench_pipeline}
+    for name in sys.argv[1:] or ['parser']:
+        for case, result in benchmarks[name]().items():
+            print(name, case, json.dumps(result))
@@ -0,0 +1,366 @@
+import re
+import json
+import base64
+import random
+import threading
+import multiprocessing
+from collections import Counter
+from datetime import date, timedelta
+from email.mime.text import MIMEText
+from email.parser import BytesParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+
+ITEMS = ['Pienas ROKIŠKIO 2,5% 1L', 'Duona BOČIŲ juoda 800g', 'Bananai, kg', 'Kiaušiniai M 10vnt.',
+         'Sūris DŽIUGAS 36 mėn. brandintas 180g', 'Obuoliai LIGOL, kg', 'Vištienos krūtinėlės filė',
+         'Makaronai BARILLA Spaghetti No.5 500g', 'Jogurtas ACTIVIA braškių 4x120g', 'Kava LAVAZZA 250g']
+
+RECEIPT_SENDER = 'noreply.code.provider@maxima.lt'
+
+
+def synthetic_receipt(day=None, items_count=None, rng=random):
+    """
+    Generates HTML part of Maxima receipt email with random items.
+    :param day. Purchase date, random date of 2019 if not provided.
+    :param items_count. Number of purchased items, random if not provided.
+    :param rng. Random number generator (e.g random.Random(seed) for reproducible receipt).
+    :return str. HTML part of receipt email.
+    """
+    day = day or date(2019, 1, 1) + timedelta(days=rng.randint(0, 364))
+    lines = ['MAXIMA LT, UAB', 'Savanorių pr. 247, Vilnius', 'PVM mok. kodas LT230335113']
+    total = 0
+    for _ in range(items_count or rng.randint(1, 40)):
+        name = rng.choice(ITEMS)
+        price = rng.randint(19, 1999)
+        total += price
+        if len(name) > 24:
+            lines.extend([name, f'{price // 100},{price % 100:02d} A'.rjust(40)])
+        else:
+            lines.append(f'{name:<30}{price // 100},{price % 100:02d} A')
+        if rng.random() < 0.1:
+            lines.append(f'{"Nuolaida":<30}-0,10 A')
+    lines.append(f'{"Mokėti":<30}{total // 100},{total % 100:02d}')
+    lines.append(f'Kvitas Nr. 00{rng.randint(1000, 9999)} {day:%Y %m %d} 18:{rng.randint(10, 59)}')
+    receipt = '\n'.join(lines)
+    return (f'<html><head><style>pre {{font-family: monospace;}}</style></head><body>'
+            f'<table><tr><td><pre>\nMAXIMA\n</pre></td></tr></table>'
+            f'<div><pre style="font-size: 12px">\n{receipt}\n</pre></div>'
+            f'<p>Ačiū, kad apsiperkate MAXIMA &amp; laukiame sugrįžtant!</p></body></html>')
+
+
+def synthetic_message(message_id, day):
+    """
+    Generates raw Gmail message of Maxima receipt. Receipt content depends only on message id.
+    :param message_id. Gmail message id.
+    :param day. Purchase date.
+    :return dict. Message in Gmail format='raw' response format.
+    """
+    message = MIMEText(synthetic_receipt(day, rng=random.Random(message_id)), 'html', 'utf-8')
+    message['from'] = f'MAXIMA <{RECEIPT_SENDER}>'
+    message['subject'] = 'Jūsų MAXIMA kvitas'
+    return {'id': message_id, 'raw': base64.urlsafe_b64encode(message.as_bytes()).decode()}
+
+
+class FakeGoogle:
+    """
+    Offline stand-in of Gmail (profile, messages.list/get/send and batch), Sheets
+    (spreadsheets.get, values.get/update/batchGet, batchUpdate), Drive (files.get)
+    APIs and fortune cookie site. Counts every served call.
+    """
+
+    GMAIL = re.compile(r'/users/(?P<user>[^/]+)/(?P<rest>profile|messages(?:/send|/[^/]+)?)$')
+    SHEETS = re.compile(r'/v4/spreadsheets/(?P<id>[^/:]+)(?P<rest>(?::batchUpdate)?|/values:batchGet|/values/.+)$')
+    DRIVE = re.compile(r'/drive/v3/files/(?P<id>[^/]+)$')
+    FORTUNE = re.compile(r'/fortunes/(?P<number>\d+)/?$')
+    CELL_RANGE = re.compile(r"^'?(?P<title>[^!']+)'?!(?P<c1>[A-Z])(?P<r1>\d+)(?::(?P<c2>[A-Z])(?P<r2>\d+))?$")
+
+    def __init__(self, messages=30, today_receipts=3, today=None):
+        """
+        Generates mailbox of receipt messages and month sheets for their dates.
+        :param messages. Number of receipt messages in mailbox.
+        :param today_receipts. Number of them dated today, others are spread over the last year.
+        :param today. Date which is treated as today.
+        """
+        self.today = today or date.today()
+        rng = random.Random(messages)
+        days = [self.today] * min(messages, today_receipts)
+        days += [self.today - timedelta(days=rng.randint(1, 365)) for _ in range(messages - len(days))]
+        days.sort(reverse=True)
+        self.messages = [(f'{index:016x}', day) for index, day in enumerate(days)]
+        self.days = dict(self.messages)
+        self.history_id = len(self.messages)
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.revision = 1
+        self.sheets = dict()
+        for month in sorted({(day.year, day.month) for day in days} | {(self.today.year, self.today.month)}):
+            self.__create_sheet(*month)
+
+    def __create_sheet(self, year, month):
+        """
+        Creates month sheet with week date rows (H-N of rows 3, 10, 17, 24) and weekly
+        balance table (B19:E22). Weeks start on Monday and cover today when it is in this month.
+        :param year. Year of the sheet.
+        :param month. Month of the sheet.
+        :return nothing.
+        """
+        first = date(year, month, 1)
+        start = first - timedelta(days=first.weekday())
+        if (self.today.year, self.today.month) == (year, month):
+            while self.today >= start + timedelta(weeks=4):
+                start += timedelta(weeks=1)
+        cells = dict()
+        for week in range(4):
+            week_start = start + timedelta(weeks=week)
+            for day in range(7):
+                cells[('HIJKLMN'[day], 3 + 7 * week)] = f'{week_start + timedelta(days=day):%Y-%m-%d}'
+            cells[('B', 19 + week)] = f'{week_start:%Y-%m-%d}'
+            cells[('C', 19 + week)] = f'{week_start + timedelta(days=6):%Y-%m-%d}'
+            cells[('E', 19 + week)] = '123,45'
+        self.sheets[f'{first:%Y-%m}'] = {'sheetId': len(self.sheets) + 1, 'cells': cells, 'notes': dict()}
+
+    def __read_range(self, cell_range):
+        """
+        Reads rectangular range like Sheets API does, trailing empty cells and rows are omitted.
+        :param cell_range. Range in A1 notation (e.g 2019-11!H3:N24).
+        :return dict. ValueRange.
+        """
+        match = self.CELL_RANGE.match(cell_range)
+        sheet = self.sheets[match['title']]
+        c1, r1 = match['c1'], int(match['r1'])
+        c2, r2 = match['c2'] or c1, int(match['r2'] or r1)
+        rows = list()
+        for row in range(r1, r2 + 1):
+            values = [sheet['cells'].get((chr(column), row), '') for column in range(ord(c1), ord(c2) + 1)]
+            while values and values[-1] == '':
+                values.pop()
+            rows.append(values)
+        while rows and not rows[-1]:
+            rows.pop()
+        return {'range': cell_range, 'majorDimension': 'ROWS', 'values': rows}
+
+    def __write_range(self, cell_range, values):
+        """
+        Writes values to range like values.update does.
+        :param cell_range. Range in A1 notation.
+        :param values. List of rows.
+        :return nothing.
+        """
+        match = self.CELL_RANGE.match(cell_range)
+        cells = self.sheets[match['title']]['cells']
+        for row_offset, row in enumerate(values):
+            for column_offset, value in enumerate(row):
+                cells[(chr(ord(match['c1']) + column_offset), int(match['r1']) + row_offset)] = str(value)
+
+    def __batch_update(self, requests):
+        """
+        Applies updateCells and repeatCell requests of spreadsheets.batchUpdate.
+        :param requests. List of batchUpdate requests.
+        :return nothing.
+        """
+        by_id = {sheet['sheetId']: sheet for sheet in self.sheets.values()}
+        for request in requests:
+            update = request.get('updateCells') or request.get('repeatCell')
+            cell_range = update['range']
+            sheet = by_id[cell_range['sheetId']]
+            data = update['rows'][0]['values'][0] if 'rows' in update else update['cell']
+            cell = (chr(ord('A') + cell_range['startColumnIndex']), cell_range['startRowIndex'] + 1)
+            if 'userEnteredValue' in data:
+                value = data['userEnteredValue']
+                sheet['cells'][cell] = str(value.get('numberValue', value.get('stringValue')))
+            if 'note' in data:
+                sheet['notes'][cell] = data['note']
+
+    def __list_messages(self, query):
+        """
+        Lists messages matching Gmail search query (from:, after: and before: terms).
+        :param query. Dictionary of parsed URL query parameters.
+        :return dict. messages.list response.
+        """
+        terms = dict(term.split(':', 1) for term in query.get('q', [''])[0].split() if ':' in term)
+        after = date(*map(int, terms['after'].split('/'))) if 'after' in terms else date.min
+        before = date(*map(int, terms['before'].split('/'))) if 'before' in terms else date.max
+        matches = [message_id for message_id, day in self.messages
+                   if terms.get('from', RECEIPT_SENDER) == RECEIPT_SENDER and after <= day < before]
+        offset = int(query.get('pageToken', ['0'])[0])
+        size = int(query.get('maxResults', ['100'])[0])
+        response = {'messages': [{'id': message_id, 'threadId': message_id}
+                                 for message_id in matches[offset:offset + size]],
+                    'resultSizeEstimate': len(matches)}
+        if offset + size < len(matches):
+            response['nextPageToken'] = str(offset + size)
+        return response
+
+    def dispatch(self, method, url, body):
+        """
+        Serves one API call.
+        :param method. HTTP method.
+        :param url. Request path with query.
+        :param body. Request body (bytes).
+        :return tuple. HTTP status and response (dict or str for HTML).
+        """
+        parts = urlsplit(url)
+        path, query = unquote(parts.path), parse_qs(parts.query)
+        with self.lock:
+            gmail, sheets = self.GMAIL.search(path), self.SHEETS.search(path)
+            drive, fortune = self.DRIVE.search(path), self.FORTUNE.search(path)
+            if gmail:
+                rest = gmail['rest']
+                if rest == 'profile':
+                    self.calls['gmail.getProfile'] += 1
+                    return 200, {'emailAddress': 'me@example.com', 'historyId': str(self.history_id)}
+                if rest == 'messages':
+                    self.calls['gmail.messages.list'] += 1
+                    return 200, self.__list_messages(query)
+                if rest == 'messages/send':
+                    self.calls['gmail.messages.send'] += 1
+                    self.history_id += 1
+                    return 200, {'id': f'sent{self.history_id}', 'labelIds': ['SENT']}
+                self.calls['gmail.messages.get'] += 1
+                message_id = rest.split('/')[1]
+                day = self.days.get(message_id)
+                if day is None:
+                    return 404, {'error': {'code': 404, 'message': 'Not Found'}}
+                return 200, synthetic_message(message_id, day)
+            if sheets:
+                rest = sheets['rest']
+                if rest == '':
+                    self.calls['sheets.get'] += 1
+                    return 200, {'sheets': [{'properties': {'title': title, 'sheetId': sheet['sheetId']}}
+                                            for title, sheet in self.sheets.items()]}
+                if rest == ':batchUpdate':
+                    self.calls['sheets.batchUpdate'] += 1
+                    self.__batch_update(json.loads(body)['requests'])
+                    self.revision += 1
+                    return 200, {'spreadsheetId': sheets['id'], 'replies': []}
+                if rest == '/values:batchGet':
+                    self.calls['sheets.values.batchGet'] += 1
+                    return 200, {'valueRanges': [self.__read_range(cell_range) for cell_range in query['ranges']]}
+                cell_range = rest[len('/values/'):]
+                if method == 'PUT':
+                    self.calls['sheets.values.update'] += 1
+                    self.__write_range(cell_range, json.loads(body)['values'])
+                    self.revision += 1
+                    return 200, {'updatedRange': cell_range}
+                self.calls['sheets.values.get'] += 1
+                return 200, self.__read_range(cell_range)
+            if drive:
+                self.calls['drive.files.get'] += 1
+                return 200, {'id': drive['id'], 'version': str(self.revision)}
+            if fortune:
+                self.calls['fortune'] += 1
+                return 200, (f'<html><body><div class="fortune">Fortune number {fortune["number"]} '
+                             f'says: measure before optimizing.</div></body></html>')
+            if path == '/_stats':
+                return 200, dict(self.calls)
+        return 404, {'error': {'code': 404, 'message': f'Unknown path {path}'}}
+
+    def batch(self, content_type, body):
+        """
+        Serves Google batch HTTP request: multipart/mixed of application/http parts.
+        :param content_type. Content-Type header of batch request with boundary.
+        :param body. Batch request body (bytes).
+        :return tuple. Content-Type header and body of batch response.
+        """
+        with self.lock:
+            self.calls['batch'] += 1
+        request = BytesParser().parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+        boundary = 'batch_response_boundary'
+        response = list()
+        for part in request.get_payload():
+            inner = part.get_payload(decode=False)
+            head, _, inner_body = inner.partition('\r\n\r\n') if '\r\n\r\n' in inner else inner.partition('\n\n')
+            method, url = head.split()[:2]
+            status, result = self.dispatch(method, url, inner_body.encode())
+            response.append(f'--{boundary}\r\nContent-Type: application/http\r\n'
+                            f'Content-ID: <response-{part["Content-ID"][1:]}\r\n\r\n'
+                            f'HTTP/1.1 {status} OK\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n'
+                            f'{json.dumps(result)}\r\n')
+        response.append(f'--{boundary}--\r\n')
+        return f'multipart/mixed; boundary={boundary}', ''.join(response).encode()
+
+    def handler(self):
+        """
+        Creates HTTP request handler class which serves this stand-in.
+        :return class. BaseHTTPRequestHandler subclass.
+        """
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def __respond(self, status, content_type, content):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def __serve(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if urlsplit(self.path).path.startswith('/batch'):
+                    self.__respond(200, *fake.batch(self.headers['Content-Type'], body))
+                    return
+                status, result = fake.dispatch(self.command, self.path, body)
+                if isinstance(result, str):
+                    self.__respond(status, 'text/html; charset=utf-8', result.encode())
+                else:
+                    self.__respond(status, 'application/json; charset=UTF-8', json.dumps(result).encode())
+
+            do_GET = do_POST = do_PUT = __serve
+
+        return Handler
+
+    def serve(self, port=0):
+        """
+        Starts HTTP server in background thread.
+        :param port. Port on localhost, free port if 0.
+        :return ThreadingHTTPServer. Running server, its root URL is http://127.0.0.1:<server_port>/
+        """
+        server = ThreadingHTTPServer(('127.0.0.1', port), self.handler())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def _serve_process(messages, connection):
+    """
+    Runs stand-in server in separate process, sends its port through connection
+    and serves until connection receives stop message.
+    """
+    server = FakeGoogle(messages).serve()
+    connection.send(server.server_port)
+    connection.recv()
+    server.shutdown()
+
+
+class FakeGoogleProcess:
+    """
+    Runs FakeGoogle in separate process, so its CPU time and memory do not
+    affect measurements of the application.
+    """
+
+    def __init__(self, messages=30):
+        """
+        :param messages. Number of receipt messages in mailbox.
+        """
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_serve_process, args=(messages, child), daemon=True)
+        self.process.start()
+        self.url = f'http://127.0.0.1:{self.connection.recv()}/'
+
+    def stop(self):
+        """
+        Stops stand-in server process.
+        :return nothing.
+        """
+        self.connection.send('stop')
+        self.process.join()
+
+
+if __name__ == '__main__':
+    server = FakeGoogle(30).serve(8765)
+    print(f'Serving stand-in Google APIs on http://127.0.0.1:{server.server_port}/')
+    threading.Event().wait()
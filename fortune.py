@@ -0,0 +1,155 @@
+import os
+import re
+import html
+import json
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+FORTUNE_URL = 'http://www.myfortunecookie.co.uk/fortunes/{}/'
+FORTUNE = re.compile(r'<div[^>]*class="fortune"[^>]*>(.*?)</div>', re.S)
+TAG = re.compile('<.*?>', re.S)
+
+
+class FortuneCorpus:
+    """
+    Fortune cookies of myfortunecookie.co.uk stored locally. Corpus is synced once to
+    JSON file and fortunes are picked from memory, so daily email does not wait for
+    the site. Expired corpus and pages which failed to download are refreshed in background thread.
+    """
+
+    DEFAULT = 'Geriausia investicija - investicija į save.'
+
+    def __init__(self, filename='fortunes.json', url=FORTUNE_URL, pages=152, timeout=10, max_age_days=30,
+                 retry_interval=3600, workers=8):
+        """
+        Loads stored corpus.
+        :param filename. File where fortunes are stored.
+        :param url. Fortune page URL with page number placeholder.
+        :param pages. Number of fortune pages on the site.
+        :param timeout. Timeout of one page request in seconds.
+        :param max_age_days. Corpus older than this is synced again.
+        :param retry_interval. Seconds between attempts to download pages which failed.
+        :param workers. Number of pages downloaded at the same time.
+        """
+        self.log = logging.getLogger('FortuneCorpus')
+        self.filename = filename
+        self.url = url
+        self.pages = pages
+        self.timeout = timeout
+        self.max_age = max_age_days * 24 * 3600
+        self.retry_interval = retry_interval
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.refreshing = None
+        self.synced = 0
+        self.attempted = 0
+        self.fortunes = dict()
+        self.failed = set()
+        if os.path.exists(filename):
+            with open(filename, 'r') as ff:
+                corpus = json.load(ff)
+            self.synced, self.fortunes = corpus['synced'], corpus['fortunes']
+            self.attempted = corpus.get('attempted', self.synced)
+            self.failed = set(corpus.get('failed', []))
+        self.choices = list(self.fortunes.values())
+
+    def __fetch(self, page):
+        """
+        Downloads fortune page and extracts fortune text.
+        :param page. Page number.
+        :return tuple. Page number, fortune (None if page has no fortune) and whether download failed.
+        """
+        try:
+            response = requests.get(self.url.format(page), timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as error:
+            self.log.debug('Fortune page %d failed: %s', page, error)
+            return page, None, True
+        match = FORTUNE.search(response.text)
+        if match is None:
+            return page, None, False
+        return page, html.unescape(TAG.sub('', match.group(1))).strip() or None, False
+
+    def __expired(self):
+        """
+        Checks whether corpus was never synced or is older than max age.
+        :return bool.
+        """
+        return time.time() - self.synced > self.max_age
+
+    def stale(self):
+        """
+        Checks whether corpus is older than max age or some pages failed to download.
+        Pages which have no fortune do not make corpus stale. Stale corpus is synced
+        at most once per retry interval.
+        :return bool.
+        """
+        if time.time() - self.attempted < self.retry_interval:
+            return False
+        return self.__expired() or bool(self.failed)
+
+    def sync(self, full=None):
+        """
+        Downloads fortune pages and saves corpus. Pages which failed keep
+        their previously stored fortunes and are downloaded again by next sync.
+        :param full. Download every page. If not provided, every page is downloaded
+        only when corpus is expired, otherwise only failed pages.
+        :return int. Number of fortunes in corpus.
+        """
+        full = self.__expired() if full is None else full
+        pages = range(1, self.pages + 1) if full else sorted(self.failed)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(self.__fetch, pages))
+        fetched = {str(page): fortune for page, fortune, _ in results if fortune is not None}
+        failed = {page for page, _, error in results if error}
+        with self.lock:
+            self.fortunes = dict(self.fortunes, **fetched)
+            self.choices = list(self.fortunes.values())
+            self.attempted = time.time()
+            if full and len(failed) < len(results):
+                self.synced = self.attempted
+            self.failed = failed if full else self.failed & failed
+            temporary = f'{self.filename}.tmp'
+            with open(temporary, 'w') as ff:
+                json.dump({'synced': self.synced, 'attempted': self.attempted, 'failed': sorted(self.failed),
+                           'fortunes': self.fortunes}, ff, ensure_ascii=False)
+            os.replace(temporary, self.filename)
+        self.log.info(f'Synced {len(fetched)} fortunes of {len(results)} pages, {len(failed)} pages failed')
+        return len(self.choices)
+
+    def refresh(self):
+        """
+        Starts sync in background thread if corpus is stale and sync is not running.
+        :return nothing.
+        """
+        with self.lock:
+            if not self.stale() or (self.refreshing is not None and self.refreshing.is_alive()):
+                return
+            self.refreshing = threading.Thread(target=self.__sync_logged, name='fortune-refresh', daemon=True)
+            self.refreshing.start()
+
+    def __sync_logged(self):
+        """
+        Runs sync in background thread, errors are logged.
+        :return nothing.
+        """
+        try:
+            self.sync()
+        except Exception:
+            self.log.exception('Fortune corpus sync failed')
+
+    def get(self):
+        """
+        Picks random fortune from memory and refreshes corpus in background if needed.
+        :return str. Fortune cookie string, DEFAULT if corpus is still empty.
+        """
+        self.refresh()
+        choices = self.choices
+        return random.choice(choices) if choices else self.DEFAULT
+
+
+fortunes = FortuneCorpus()
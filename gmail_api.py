@@ -1,18 +1,18 @@
 from __future__ import print_function
-import pickle
-import re
 import os.path
 import base64
-import email
 import logging
-import logging.config
 import json
+import time
+import random
 from email.mime.text import MIMEText
 from datetime import datetime
 from string import ascii_uppercase
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from googleapiclient import errors
+from google_clients import clients as shared_clients
+from receipt_cache import ReceiptCache
+from receipt_parser import PARSER_VERSION, Receipt, parse_raw_message
+from metrics import metrics
 
 
 class GmailApi:
@@ -20,115 +20,246 @@ class GmailApi:
     Initiates Gmail API for reading email messages from specified sender.
     """
 
-    def __init__(self):
+    SENDER = 'noreply.code.provider@maxima.lt'
+    PAGE_SIZE = 500
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, batch_size=50, max_retries=5, state_file=None, clients=None, account=None):
         """
-        Loads logging configuration file.
         Start Gmail API initiation process.
+        :param batch_size. Number of messages requested in one batch HTTP request (Gmail allows up to 100).
+        :param max_retries. How many times failed messages of batch are requested again.
+        :param state_file. File where incremental sync state is stored between runs,
+        gmail_state.json (gmail_state_<account>.json for named account) if not provided.
+        :param clients. ClientManager which provides service client, shared one if not provided.
+        :param account. Account name which selects token of the account. None for default account.
         """
-        with open('logging.conf', 'r') as lc:
-            log = json.load(lc)
-            logging.config.dictConfig(log)
+        self.account = account
+        self.clients = clients or shared_clients
+        self.executor = self.clients.executor
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.state_file = state_file or (f'gmail_state_{account}.json' if account else 'gmail_state.json')
+        self.cache = ReceiptCache(PARSER_VERSION, account=account)
+        self.pending_state = None
         self.log = logging.getLogger('GmailApi')
         self.__init_api()
 
     def __init_api(self):
         """
-        Configures service API which is defined by variable api
-        :param str api. Service name
-        :return service. Instance of configured service (gmail or sheets)
+        Gets service client of API which is defined by variable api from shared client manager.
+        :return nothing.
         """
         api = 'gmail'
         SCOPES = ['https://mail.google.com/']
         version = 'v1'
 
-        creds = None
-        # The file token.pickle stores the user's access and refresh tokens, and is
-        # created automatically when the authorization flow completes for the first
-        # time.
-        if os.path.exists(f'creds/token_{api}.pickle'):
-            with open(f'creds/token_{api}.pickle', 'rb') as token:
-                creds = pickle.load(token)
-        # If there are no (valid) credentials available, let the user log in.
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    f'creds/credentials_{api}.json', SCOPES)
-                creds = flow.run_local_server(port=0)
-            # Save the credentials for the next run
-            with open(f'creds/token_{api}.pickle', 'wb') as token:
-                pickle.dump(creds, token)
-
-        self.service = build(api, version, credentials=creds)
+        token = f'{api}_{self.account}' if self.account else api
+        self.service = self.clients.service(api, version, token, SCOPES, secrets=api)
         self.log.debug(f'Setup completed with {api}')
 
+    def __load_state(self):
+        """
+        Loads incremental sync state saved by previous run.
+        :return dict. Last seen history id and ids of already processed receipt messages.
+        """
+        if os.path.exists(self.state_file):
+            with open(self.state_file, 'r') as sf:
+                return json.load(sf)
+        return {'history_id': None, 'message_ids': []}
+
+    def __save_state(self, state):
+        """
+        Saves incremental sync state for the next run.
+        :param state. Dictionary with history id and processed message ids.
+        :return nothing.
+        """
+        with open(self.state_file, 'w') as sf:
+            json.dump(state, sf)
+
+    def list_page(self, query='', page_token=None):
+        """
+        Lists one page of receipt sender messages (newest first).
+        :param query. Additional Gmail search query (e.g after:2019/01/01).
+        :param page_token. Token of the page, None for the first page.
+        :return tuple. List of messages and token of the next page (None on the last page).
+        """
+        request = self.service.users().messages().list(userId='me', q=f'from:{self.SENDER} {query}'.strip(),
+                                                       pageToken=page_token, maxResults=self.PAGE_SIZE)
+        results = self.executor.execute('gmail', request, cost=5)
+        return results.get('messages', []), results.get('nextPageToken')
+
+    def __list_messages(self, seen_ids):
+        """
+        Lists messages from receipt sender page by page (newest first). Paging stops
+        at the first page which contains already processed message.
+        :param seen_ids. Set of already processed message ids.
+        :return tuple. New receipt messages and ids of already processed messages of the last page.
+        """
+        messages = list()
+        page_token = None
+        while True:
+            page, page_token = self.list_page(page_token=page_token)
+            new = [message for message in page if message['id'] not in seen_ids]
+            messages.extend(new)
+            if page_token is None or len(new) < len(page):
+                return messages, [message['id'] for message in page if message['id'] in seen_ids]
+
+    def has_new_receipts(self):
+        """
+        Checks whether new receipt messages arrived since last processed ones.
+        Costs one getProfile call when mailbox did not change.
+        :return bool.
+        """
+        state = self.__load_state()
+        history_id = self.executor.execute('gmail', self.service.users().getProfile(userId='me')).get('historyId')
+        if state['history_id'] == history_id:
+            return False
+        seen_ids = set(state['message_ids'])
+        page, _ = self.list_page()
+        if any(message['id'] not in seen_ids for message in page):
+            return True
+        # Mailbox changed without new receipts, nothing to do until it changes again
+        state['history_id'] = history_id
+        self.__save_state(state)
+        return False
+
     def get_receipts(self):
         """
-        Iterates through 30 email messages. Then results are sent to __parse_messages() method
-        which returns receipts in list.
+        Gets receipts of messages which were not processed by previous runs.
         return list. Parsed receipts from email messages in list.
         """
-        self.log.info('Getting 30 newest email messages ..')
-        results = self.service.users().messages().list(userId='me', maxResults=30).execute()
+        return list(self.iter_receipts())
+
+    def iter_receipts(self):
+        """
+        Lists messages of receipt sender which were not processed by previous runs and yields
+        their receipts one at a time. If mailbox history id did not change since last run,
+        nothing is listed at all. Messages are processed batch by batch: already parsed ones are
+        taken from receipt cache, others are downloaded and parsed by __parse_messages(), so at
+        most one batch of cached receipts and raw messages is held in memory. When all receipts are yielded, new sync state is
+        kept pending until commit_sync() is called after receipts are written.
+        :return generator. Parsed receipts in message order (newest first).
+        """
+        state = self.__load_state()
+        history_id = self.executor.execute('gmail', self.service.users().getProfile(userId='me')).get('historyId')
+        if state['history_id'] is not None and state['history_id'] == history_id:
+            self.log.info('Mailbox did not change since last run')
+            return
+
+        self.log.info('Getting new receipt messages ..')
+        seen_ids = set(state['message_ids'])
+        messages, known_ids = self.__list_messages(seen_ids)
+        self.log.debug('Got %d new receipt messages', len(messages))
+        processed = list()
+        for start in range(0, len(messages), self.batch_size):
+            chunk = messages[start:start + self.batch_size]
+            cached = {message_id: Receipt(*receipt)._replace(message_id=message_id) if receipt is not None else None
+                      for message_id, receipt in self.cache.get_many(message['id'] for message in chunk).items()}
+            metrics.count('receipt_cache_hits_total', len(cached))
+            metrics.count('receipt_cache_misses_total', len(chunk) - len(cached))
+            raw_messages = self.__fetch_batch([message['id'] for message in chunk if message['id'] not in cached])
+            parsed = dict(self.__parse_messages(raw_messages))
+            self.cache.put_many(parsed)
+            for message in chunk:
+                receipts = cached if message['id'] in cached else parsed
+                if message['id'] not in receipts:
+                    continue
+                processed.append(message['id'])
+                if receipts[message['id']] is not None:
+                    yield receipts[message['id']]
+
+        # Paging of the next run stops at the first page with processed message, so only
+        # newest page of processed ids is kept and state does not grow with every receipt
+        state['history_id'] = history_id
+        state['message_ids'] = (processed + known_ids)[:self.PAGE_SIZE]
+        self.pending_state = state
 
-        messages = results.get('messages', [])
-        return self.__parse_messages(messages)
+    def commit_sync(self):
+        """
+        Saves sync state of the last iter_receipts() call, so its messages are not listed again.
+        Called only after receipts are written, failed writes are retried by the next run.
+        :return nothing.
+        """
+        if self.pending_state is not None:
+            self.__save_state(self.pending_state)
+            self.pending_state = None
+
+    def __batch_callback(self, fetched, failed):
+        """
+        Creates callback for batch HTTP request which stores downloaded messages
+        and collects ids of messages which should be requested again.
+        :param fetched. Dictionary where downloaded messages are stored by message id.
+        :param failed. List where ids of retryable failed messages are added.
+        :return function. Callback for BatchHttpRequest.add()
+        """
+        def callback(request_id, response, exception):
+            if exception is None:
+                metrics.count('gmail_messages_fetched_total', status='ok')
+                fetched[request_id] = response
+            elif isinstance(exception, errors.HttpError) and exception.resp.status in self.RETRY_STATUSES:
+                metrics.count('gmail_messages_fetched_total', status=exception.resp.status)
+                failed.append(request_id)
+            else:
+                metrics.count('gmail_messages_fetched_total', status='skipped')
+                self.log.warning('Skipping message %s: %s', request_id, exception)
+        return callback
 
-    def __parse_messages(self, messages):
+    def iter_batches(self, messages):
         """
-        From first 30 emails finds messages with selected sender email.
-        Then those messages are parsed to receipt items.
+        Downloads raw email messages with Gmail batch HTTP requests of batch_size messages
+        and yields them one batch at a time.
         :param messages. List of email messages.
-        :return nested list. List of receipts items. (Cost and purchase list)
-        """
-        self.log.debug('Looping through available messages')
-        self.data = list()
-        for message in messages:
-
-            msg = self.service.users().messages().get(userId='me', id=message['id'], format='raw').execute()
-            try:
-                msg_str = str(base64.urlsafe_b64decode(msg['raw'].encode('ASCII')), 'utf-8')
-            except UnicodeDecodeError:
-                continue
-
-            mime_msg = email.message_from_string(msg_str)
-
-            last_item = ''
-            receipt_items = list()
-            items = list()
-
-            try:
-                sender_email = re.search('<(.*)>', mime_msg['from']).group(1)
-            except AttributeError:
-                continue
-
-            if sender_email == 'noreply.code.provider@maxima.lt':
-                self.log.debug('Got receipt! Now parsing .. ')
-                for part in mime_msg.walk():
-                    if part.get_content_type() == 'text/html':
-                        payload = part.get_payload(decode=True).decode('utf-8')
-                        from bs4 import BeautifulSoup
-                        soup = BeautifulSoup(payload, 'lxml')
-                        receipt_html = soup.findAll(lambda tag: tag.name == 'pre')
-                        receipt = str(receipt_html[1]).splitlines()[1:]
-                        receipt_items.append('-'.join(receipt[-2].split()[3:6]))
-                        for line in receipt:
-                            if line.find('Mokėti') != -1:
-                                receipt_items.append('-' + line.split()[-1])
-                            elif not line.endswith(' A'):
-                                last_item = line
-                                continue
-                            elif line.startswith('Nuolaida'):
-                                continue
-                            else:
-                                line = last_item + ' ' + line
-                                items.append(' '.join(line.split()[:-2]))
-                                last_item = ''
-                receipt_items.append(items)
-                self.data.append(receipt_items)
-        self.log.debug('Parsing completed! Number of receipts {0}'.format(len(self.data)))
-        return self.data
+        :return generator. Lists of raw email messages in the same order as provided messages.
+        """
+        for start in range(0, len(messages), self.batch_size):
+            yield self.__fetch_batch([message['id'] for message in messages[start:start + self.batch_size]])
+
+    def __fetch_batch(self, message_ids):
+        """
+        Downloads raw email messages with one Gmail batch HTTP request. Messages which failed
+        with quota or server errors are requested again with exponential backoff.
+        :param message_ids. List of message ids, at most batch_size.
+        :return list. Raw email messages in the same order as provided ids.
+        """
+        fetched = dict()
+        pending = message_ids
+        attempt = 0
+        while pending:
+            failed = list()
+            batch = self.service.new_batch_http_request(callback=self.__batch_callback(fetched, failed))
+            # Every users().messages() call builds new resource objects with reference cycles
+            messages = self.service.users().messages()
+            for message_id in pending:
+                batch.add(messages.get(userId='me', id=message_id, format='raw'), request_id=message_id)
+            self.executor.execute('gmail', batch, cost=5 * len(pending))
+            if not failed:
+                break
+            attempt += 1
+            if attempt > self.max_retries:
+                self.log.warning('Giving up on %d messages after %d retries', len(failed), self.max_retries)
+                break
+            delay = 2 ** (attempt - 1) + random.random()
+            self.log.debug('Retrying %d messages in %.1f seconds', len(failed), delay)
+            time.sleep(delay)
+            pending = failed
+        return [fetched.pop(message_id) for message_id in message_ids if message_id in fetched]
+
+    def __parse_messages(self, raw_messages):
+        """
+        From downloaded emails finds messages with selected sender email and parses them
+        to receipt items one at a time. Every raw message is removed from provided list
+        before it is parsed, so its buffers are freed as soon as it is processed.
+        :param raw_messages. List of downloaded email messages, emptied by this generator.
+        :return generator. Tuples of message id and receipt (None if message is not a receipt).
+        """
+        raw_messages.reverse()
+        while raw_messages:
+            msg = raw_messages.pop()
+            with metrics.timer('receipt_parse_seconds'):
+                receipt = parse_raw_message(msg, self.SENDER)
+            metrics.count('messages_parsed_total', receipt=receipt is not None)
+            yield msg['id'], receipt
 
     def create_message(self, sender, to, subject, message_text):
         """
@@ -158,7 +289,9 @@ class GmailApi:
         Returns: Sent Message.
         """
         try:
-            message = (self.service.users().messages().send(userId=user_id, body=message).execute())
+            # Email sent before timeout or server error would be sent again by retry
+            message = self.executor.execute('gmail', self.service.users().messages().send(userId=user_id, body=message),
+                                            cost=100, idempotent=False)
             return message
         except errors.HttpError:
             return
@@ -0,0 +1,162 @@
+import os.path
+import json
+import pickle
+import logging
+import threading
+from datetime import datetime, timedelta
+import httplib2
+import google_auth_httplib2
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from google_auth_oauthlib.flow import InstalledAppFlow
+from google.auth.transport.requests import Request
+from request_executor import RequestExecutor
+
+
+class ClientManager:
+    """
+    Loads credentials and builds Google API service clients once per process.
+    Discovery documents are taken from the ones bundled with google-api-python-client
+    and parsed once, so clients of many accounts share them. Services of the same
+    token share one authorized keep-alive HTTP transport.
+    Requests of all services are executed by shared RequestExecutor.
+    """
+
+    # Tokens are refreshed this long before they expire, so no request waits for refresh
+    REFRESH_MARGIN = timedelta(minutes=5)
+
+    def __init__(self, creds_dir='creds', timeout=60, executor=None, root_url=None, http_class=httplib2.Http):
+        """
+        :param creds_dir. Directory of credentials_<token>.json and token_<token>.pickle files.
+        :param timeout. HTTP socket timeout in seconds.
+        :param executor. RequestExecutor, one with default quotas if not provided.
+        :param root_url. Root URL which replaces Google API endpoints (e.g offline stand-in server).
+        No credentials are used when it is set.
+        :param http_class. HTTP transport class.
+        """
+        self.log = logging.getLogger('ClientManager')
+        self.creds_dir = creds_dir
+        self.timeout = timeout
+        self.credentials = dict()
+        self.transports = dict()
+        self.services = dict()
+        self.documents = dict()
+        self.lock = threading.Lock()
+        self.executor = executor or RequestExecutor()
+        self.root_url = root_url
+        self.http_class = http_class
+
+    def __save(self, token, creds):
+        """
+        Saves the credentials for the next run.
+        :param token. Token name (e.g gmail).
+        :param creds. Credentials.
+        :return nothing.
+        """
+        with open(os.path.join(self.creds_dir, f'token_{token}.pickle'), 'wb') as token_file:
+            pickle.dump(creds, token_file)
+
+    def __load(self, token, scopes, secrets):
+        """
+        Loads credentials of the token. If there are no (valid) credentials available,
+        lets the user log in.
+        :param token. Token name (e.g gmail).
+        :param scopes. List of required scopes.
+        :param secrets. Name of client secrets file (credentials_<secrets>.json).
+        :return Credentials.
+        """
+        creds = None
+        # The file token.pickle stores the user's access and refresh tokens, and is
+        # created automatically when the authorization flow completes for the first
+        # time.
+        token_path = os.path.join(self.creds_dir, f'token_{token}.pickle')
+        if os.path.exists(token_path):
+            with open(token_path, 'rb') as token_file:
+                creds = pickle.load(token_file)
+        if not creds or not (creds.valid or creds.refresh_token):
+            flow = InstalledAppFlow.from_client_secrets_file(
+                os.path.join(self.creds_dir, f'credentials_{secrets}.json'), scopes)
+            creds = flow.run_local_server(port=0)
+            self.__save(token, creds)
+        return creds
+
+    def refresh(self, token):
+        """
+        Refreshes token if it expires within REFRESH_MARGIN.
+        :param token. Token name (e.g gmail).
+        :return nothing.
+        """
+        creds = self.credentials[token]
+        if creds.expiry is None or creds.expiry - datetime.utcnow() > self.REFRESH_MARGIN:
+            return
+        self.log.debug(f'Refreshing {token} token')
+        creds.refresh(Request())
+        self.__save(token, creds)
+
+    def refresh_all(self):
+        """
+        Refreshes every loaded token which expires within REFRESH_MARGIN.
+        Called before each run of long running process.
+        :return nothing.
+        """
+        with self.lock:
+            for token in self.credentials:
+                self.refresh(token)
+
+    def __document(self, api, version):
+        """
+        Gets parsed discovery document bundled with google-api-python-client.
+        :param api. Service name (e.g gmail).
+        :param version. Service version (e.g v1).
+        :return dict. Discovery document.
+        """
+        if (api, version) not in self.documents:
+            document = json.loads(get_static_doc(api, version))
+            if self.root_url is not None:
+                document['rootUrl'] = self.root_url
+                document['baseUrl'] = self.root_url + document['servicePath']
+            self.documents[(api, version)] = document
+        return self.documents[(api, version)]
+
+    def __offline_service(self, api, version, token):
+        """
+        Gets service client of stand-in server without credentials.
+        :param api. Service name (e.g gmail).
+        :param version. Service version (e.g v1).
+        :param token. Token name, services of the same token share transport.
+        :return service. Service client.
+        """
+        if token not in self.transports:
+            self.transports[token] = self.http_class(timeout=self.timeout)
+        key = (api, version, token)
+        if key not in self.services:
+            self.services[key] = build_from_document(self.__document(api, version), http=self.transports[token])
+        return self.services[key]
+
+    def service(self, api, version, token, scopes, secrets=None):
+        """
+        Gets service client, building it on the first call.
+        :param api. Service name (e.g gmail).
+        :param version. Service version (e.g v1).
+        :param token. Token name, services of the same account and scopes share it.
+        :param scopes. List of required scopes.
+        :param secrets. Name of client secrets file, token name if not provided.
+        :return service. Service client.
+        """
+        with self.lock:
+            if self.root_url is not None:
+                return self.__offline_service(api, version, token)
+            if token not in self.credentials:
+                self.credentials[token] = self.__load(token, scopes, secrets or token)
+                self.transports[token] = google_auth_httplib2.AuthorizedHttp(
+                    self.credentials[token], http=self.http_class(timeout=self.timeout))
+            self.refresh(token)
+            key = (api, version, token)
+            if key not in self.services:
+                self.services[key] = build_from_document(self.__document(api, version),
+                                                         http=self.transports[token])
+                self.log.debug(f'Setup completed with {api}')
+            return self.services[key]
+
+
+clients = ClientManager()
@@ -0,0 +1,84 @@
+import copy
+import json
+import queue
+import atexit
+import logging
+import logging.config
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log record as one line JSON object, e.g for log shipping.
+    """
+
+    def format(self, record):
+        """
+        :param record. Log record.
+        :return str. JSON object with time, level, logger, thread, message and exception.
+        """
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class RecordQueueHandler(QueueHandler):
+    """
+    Puts log records to queue. Only message arguments are merged in calling thread,
+    time, level and formatter of every handler are applied by listener thread.
+    Exception traceback is kept separate from message, so JSON sink gets it as own field.
+    """
+
+    def prepare(self, record):
+        """
+        :param record. Log record.
+        :return LogRecord. Copy of record which can be safely handled in other thread.
+        """
+        record = copy.copy(record)
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(config='logging.conf', json_file=None):
+    """
+    Configures logging once per process. Handlers of logging configuration file (and optional
+    JSON lines file) are moved to QueueListener thread, root logger only puts records to queue,
+    so console and file I/O is not done by worker threads. Further calls do nothing.
+    :param config. Logging configuration file (dictConfig JSON).
+    :param json_file. File of structured JSON log lines, not written if not provided.
+    :return QueueListener.
+    """
+    global listener
+    if listener is not None:
+        return listener
+    with open(config, 'r') as lc:
+        logging.config.dictConfig(json.load(lc))
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    if json_file is not None:
+        json_handler = RotatingFileHandler(json_file, maxBytes=104857600, backupCount=2, encoding='utf-8')
+        json_handler.setFormatter(JsonFormatter())
+        handlers.append(json_handler)
+    records = queue.SimpleQueue()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(RecordQueueHandler(records))
+    # Every handler keeps its own level (e.g console INFO, rotating file DEBUG)
+    listener = QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
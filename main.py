@@ -1,111 +1,218 @@
 from gmail_api import GmailApi
 from sheets_api import SheetsApi
-from threading import Timer
+from backfill import Backfill
+from scheduler import CronSchedule, Scheduler
+from metrics import metrics, profile as profile_run
+from fortune import fortunes as shared_fortunes
+from log_setup import setup_logging
 from datetime import datetime
-from bs4 import BeautifulSoup
-import requests
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import argparse
+import time
 import logging
-import logging.config
 import json
-import re
-import random
-
-def get_fortune():
-    """
-    Gets todays fortune by executing curl to myfortunecookie.co.uk site
-    Parses request for fortune string output
-    :return str. Fortune cookie string
-    """
-    rnd_num = random.randint(1,152)
-    req = requests.get(f'http://www.myfortunecookie.co.uk/fortunes/{rnd_num}/')
-    soup = BeautifulSoup(req.text, 'lxml')
-    try:
-        fortune = soup.find_all('div', {'class':'fortune'})[0]
-    except IndexError:
-        get_fortune()
-    clean = re.compile('<.*?>')
-    return re.sub(clean, '', str(fortune))
 
 
 class MainApp:
 
-    def __init__(self, start_time):
+    def __init__(self, start_time, use_async=False, account=None, spreadsheet_id=None,
+                 sender='maxima.test.api@gmail.com', recipient='lukas.stankovicius@gmail.com',
+                 clients=None, layout_index=None, profile=None, fortunes=None):
         """
         Initiates Gmail API class which is responsible for getting messages from specified email.
         Initiates Sheets API class which is responsible for writing values to spreadsheet cell.
+        :param start_time. Time of the day when application runs (e.g 12:00:01)
+        :param use_async. Run independent I/O stages concurrently with asyncio.
+        :param account. Account name, selects tokens and sync state of the account. None for default account.
+        :param spreadsheet_id. Spreadsheet of the account, default spreadsheet if not provided.
+        :param sender. Email address balance email is sent from.
+        :param recipient. Email address balance email is sent to.
+        :param clients. ClientManager shared between accounts, default shared one if not provided.
+        :param layout_index. LayoutIndex shared between accounts.
+        :param profile. Profile next run with 'cprofile' or 'tracemalloc'.
+        :param fortunes. FortuneCorpus, default shared one if not provided.
         """
-        self.gmail = GmailApi()
-        self.sheets = SheetsApi()
+        self.gmail = GmailApi(account=account, clients=clients)
+        self.sheets = SheetsApi(account=account, spreadsheet_id=spreadsheet_id, clients=clients,
+                                layout_index=layout_index)
+        self.sender = sender
+        self.recipient = recipient
+        self.fortunes = fortunes or shared_fortunes
 #        self.postgre = PostgreSQL()
-        self.is_running = False
         self.start_time = start_time
-        with open('logging.conf', 'r') as lc:
-            log = json.load(lc)
-            logging.config.dictConfig(log)
+        self.use_async = use_async
+        self.timings = dict()
+        self.profile = profile
+        self.summary_file = f'run_summary_{account}.json' if account else 'run_summary.json'
+        self.profile_file = f'run_profile_{account}' if account else 'run_profile'
+        self.labels = {'account': account or 'main'}
         self.log = logging.getLogger('MainApp')
 
-    def __run(self):
+    def run_once(self):
+        """
+        Runs daily sequence either sequentially or with asyncio pipeline. Stage timings
+        and metrics recorded during the run are written to JSON run summary. Metrics are labeled
+        by account, so summary has only this account's metrics when accounts run concurrently.
+        If profiling was requested, this run is profiled.
+        :return: nothing.
+        """
+        self.timings = dict()
+        since = metrics.snapshot()
+        kind, self.profile = self.profile, None
+        self.gmail.clients.refresh_all()
+        started = time.perf_counter()
+        try:
+            with metrics.context(**self.labels), profile_run(kind, self.profile_file):
+                if self.use_async:
+                    asyncio.run(self.__run_async())
+                else:
+                    self.__run_sequential()
+        finally:
+            self.timings['total'] = time.perf_counter() - started
+            self.log.info('Run timings: ' + ', '.join(f'{stage} {seconds:.2f}s'
+                                                      for stage, seconds in self.timings.items()))
+            metrics.write_summary(self.summary_file, since, self.labels, finished=datetime.now().isoformat(),
+                                  stages={stage: round(seconds, 4) for stage, seconds in self.timings.items()})
+
+    def __send_balance(self, balance, fortune):
+        """
+        Sends weekly balance and fortune of the day by email.
+        :param balance. Weekly balance.
+        :param fortune. Fortune cookie string.
+        :return nothing.
+        """
+        text = f'Labas,\nSavaitės likutis: {balance}\n\nŠios dienos palinkėjimas: {fortune}'
+        mes = self.gmail.create_message(self.sender, self.recipient, 'FINANSAI: Likęs balansas savaitei', text)
+        self.gmail.send_message('me', mes)
+
+    def __timed(self, stage, function, *args):
+        """
+        Calls function and records how long it took.
+        :param stage. Stage name used in run timings.
+        :param function. Function which is called.
+        :return function result.
+        """
+        started = time.perf_counter()
+        try:
+            with metrics.context(**self.labels):
+                return function(*args)
+        finally:
+            self.timings[stage] = time.perf_counter() - started
+            metrics.observe('stage_seconds', self.timings[stage], stage=stage, **self.labels)
+
+    def __run_sequential(self):
         """
         Gets receipts from gmail in list. Then provides following receipt list to write_to_sheet method
         which writes values to correct cell.
         :return: nothing.
         """
         self.log.info('Starting to get receipts from Gmail API ..')
-        self.is_running = False
-        receipts = self.gmail.get_receipts()
+        receipts = self.__timed('gmail', self.gmail.get_receipts)
         self.log.info('Got receipts!')
 #        self.postgre.insert_data(receipts)
         self.log.info('Starting to write to Google Sheets spreadsheet .. ')
-        self.sheets.write_to_sheet(receipts)
+        self.__timed('sheets_write', self.sheets.write_to_sheet, receipts)
+        self.gmail.commit_sync()
         self.log.info('Writting to spreadsheet completed!')
-        balance = self.sheets.get_weekly_balance()
-        fortune = get_fortune()
-        text = f'Labas,\nSavaitės likutis: {balance}\n\nŠios dienos palinkėjimas: {fortune}'
-        mes = self.gmail.create_message('maxima.test.api@gmail.com', 'lukas.stankovicius@gmail.com', 'FINANSAI: Likęs balansas savaitei', text)
-        self.gmail.send_message('me', mes)
-        self.start()
-    
-    def __time_to_seconds(self, time):
-        """
-        Converts specified time into seconds
-        :param time. Specified time (e.g 12:00:01)
-        :return int. Time in seconds
-        """
-        h, m, s = time.split(':')
-        return int(h) * 3600 + int(m) * 60 + int(s)
+        balance = self.__timed('balance', self.sheets.get_weekly_balance)
+        fortune = self.__timed('fortune', self.fortunes.get)
+        self.__timed('send', self.__send_balance, balance, fortune)
 
-    def __get_wait_time(self):
+    async def __run_async(self):
         """
-        Gets required amount of time to wait before starting main applications sequence.
-        :return int. Required amount of time to wait in seconds
+        Runs daily sequence with asyncio. Gmail fetch, sheet layout loading and fortune fetch
+        are run concurrently in bounded thread pool. Parsed receipts are added to sheet write
+        buffer as they arrive. Every service is used by one thread at a time, because
+        its HTTP transport is not thread safe.
+        :return: nothing.
         """
-        current_time = datetime.now().strftime('%H:%M:%S')
-        wait_time = self.__time_to_seconds(self.start_time) - self.__time_to_seconds(current_time)
+        loop = asyncio.get_running_loop()
+        receipts = asyncio.Queue()
+        done = object()
+
+        def stream_receipts():
+            try:
+                for receipt in self.gmail.iter_receipts():
+                    loop.call_soon_threadsafe(receipts.put_nowait, receipt)
+            finally:
+                loop.call_soon_threadsafe(receipts.put_nowait, done)
 
-        if wait_time < 0:
-            wait_time = 24 * 3600 + wait_time
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            def stage(name, function, *args):
+                return loop.run_in_executor(executor, self.__timed, name, function, *args)
 
-        return wait_time
+            self.log.info('Starting to get receipts from Gmail API ..')
+            gmail = stage('gmail', stream_receipts)
+            fortune = stage('fortune', self.fortunes.get)
+            await stage('sheets_prepare', self.sheets.prepare)
+            while True:
+                receipt = await receipts.get()
+                if receipt is done:
+                    break
+                self.sheets.add_receipt(receipt)
+            await gmail
+            self.log.info('Got receipts! Writting to Google Sheets spreadsheet ..')
+            await stage('sheets_write', self.sheets.flush)
+            self.gmail.commit_sync()
+            balance = await stage('balance', self.sheets.get_weekly_balance)
+            await stage('send', self.__send_balance, balance, await fortune)
 
-    def start(self, wait=True):
+    def start(self, wait=True, watch=False, cron=None):
         """
-        Gets required wait time to start application by calling __get_wait_time() method.
-        Initiates Timer() class with specified wait interval.
-        :param wait. Boolean indicating whether wait for start time or not.
+        Starts scheduler which runs daily sequence at start time (or by cron expression).
+        :param wait. Boolean indicating whether wait for start time or run immediately first.
+        :param watch. Also run as soon as new receipts arrive in Gmail.
+        :param cron. Cron expression which replaces daily start time (e.g '0 */6 * * *').
         :return nothing.
         """
-        self.log.info('Getting required amount of wait time ..')
-        wait_time = self.__get_wait_time()
-        self.log.debug(f'Wait time in seconds - {wait_time}')
-        if wait is False:
-            self.__run()
-        if not self.is_running:
-            self.__timer = Timer(wait_time, self.__run)
-            self.__timer.start()
-            self.is_running = True
-            self.log.info(f'Waiting for {self.start_time}')
+        schedule = CronSchedule(cron) if cron else CronSchedule.daily(self.start_time)
+        self.scheduler = Scheduler(self.run_once, schedule, name=self.gmail.account or 'main',
+                                   watch=self.gmail.has_new_receipts if watch else None)
+        self.scheduler.start(run_now=wait is False)
 
 
 if __name__ == '__main__':
-    m = MainApp("22:25:00")
-    m.start(False)
+    parser = argparse.ArgumentParser(description='Writes Maxima receipts from Gmail to Google Sheets.')
+    subparsers = parser.add_subparsers(dest='command')
+    backfill = subparsers.add_parser('backfill', help='Write every receipt of date range.')
+    backfill.add_argument('--since', required=True, help='First date (e.g 2019-01-01)')
+    backfill.add_argument('--until', default=datetime.today().strftime('%Y-%m-%d'), help='Last date, today by default')
+    backfill.add_argument('--workers', type=int, help='Number of parsing processes')
+    accounts = subparsers.add_parser('accounts', help='Run every account of accounts config.')
+    accounts.add_argument('--config', default='accounts.json', help='Accounts config file')
+    accounts.add_argument('--workers', type=int, default=4, help='Number of accounts processed at the same time')
+    subparsers.add_parser('fortunes', help='Sync local fortune corpus.')
+    analytics = subparsers.add_parser('analytics', help='Print spending summary of cached receipts.')
+    analytics.add_argument('--since', help='First date (e.g 2019-01-01)')
+    analytics.add_argument('--until', help='Last date')
+    analytics.add_argument('--top', type=int, default=10, help='Number of top items')
+    analytics.add_argument('--account', help='Account of accounts config, default account if not provided')
+    parser.add_argument('--watch', action='store_true', help='Also run as soon as new receipts arrive')
+    parser.add_argument('--cron', help='Cron expression which replaces daily start time')
+    parser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on this port')
+    parser.add_argument('--profile', choices=['cprofile', 'tracemalloc'], help='Profile the first run')
+    parser.add_argument('--log-json', help='Also write structured JSON log lines to this file')
+    args = parser.parse_args()
+    setup_logging(json_file=args.log_json)
+
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+
+    if args.command == 'backfill':
+        Backfill(GmailApi(), SheetsApi(), args.since, args.until, args.workers).run()
+    elif args.command == 'fortunes':
+        shared_fortunes.sync(full=True)
+    elif args.command == 'analytics':
+        from analytics import SpendingAnalytics
+        from receipt_cache import ReceiptCache
+        from receipt_parser import PARSER_VERSION
+        spending = SpendingAnalytics.from_cache(ReceiptCache(PARSER_VERSION, account=args.account))
+        summary = spending.summary(args.since, args.until, args.top)
+        print(json.dumps(summary, ensure_ascii=False, indent=1))
+    elif args.command == 'accounts':
+        from runner import AccountRunner
+        AccountRunner(args.config, args.workers).start(False, cron=args.cron)
+    else:
+        m = MainApp("22:25:00", profile=args.profile)
+        m.start(False, watch=args.watch, cron=args.cron)
@@ -0,0 +1,225 @@
+import json
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class Metrics:
+    """
+    Lightweight in-process counters and timers. Every metric is identified by name and
+    labels. Metrics are exported in Prometheus text format or as JSON run summary.
+    Labels set by context() (e.g account) are added to every metric recorded by the thread.
+    """
+
+    def __init__(self):
+        self.log = logging.getLogger('Metrics')
+        self.counters = dict()
+        self.timers = dict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextmanager
+    def context(self, **labels):
+        """
+        Adds labels to every metric recorded by current thread inside the block.
+        :param labels. Labels (e.g account='main').
+        """
+        previous = getattr(self.local, 'labels', dict())
+        self.local.labels = dict(previous, **labels)
+        try:
+            yield
+        finally:
+            self.local.labels = previous
+
+    def __key(self, name, labels):
+        """
+        Builds metric key of name, context labels and provided labels.
+        :param name. Metric name.
+        :param labels. Metric labels.
+        :return tuple. Name and sorted labels.
+        """
+        return name, tuple(sorted(dict(getattr(self.local, 'labels', dict()), **labels).items()))
+
+    def count(self, name, value=1, **labels):
+        """
+        Increases counter.
+        :param name. Counter name (e.g api_retries_total).
+        :param value. Value added to counter.
+        :param labels. Counter labels (e.g api='gmail').
+        :return nothing.
+        """
+        key = self.__key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """
+        Records duration of one timed operation.
+        :param name. Timer name (e.g api_request_seconds).
+        :param seconds. Duration.
+        :param labels. Timer labels.
+        :return nothing.
+        """
+        key = self.__key(name, labels)
+        with self.lock:
+            count, total = self.timers.get(key, (0, 0.0))
+            self.timers[key] = (count + 1, total + seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Times block of code.
+        :param name. Timer name.
+        :param labels. Timer labels.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """
+        Gets copy of current values, used for computing summary of one run.
+        :return dict.
+        """
+        with self.lock:
+            return {'counters': dict(self.counters), 'timers': dict(self.timers)}
+
+    def summary(self, since=None, labels=None):
+        """
+        Gets metrics as JSON serializable dictionary.
+        :param since. Snapshot taken at the start of the run, whole process metrics if not provided.
+        :param labels. Only metrics with these label values are included (e.g {'account': 'main'}).
+        :return dict. Counters and timers (count, total and mean seconds) by name and labels.
+        """
+        since = since or {'counters': dict(), 'timers': dict()}
+        labels = set((labels or dict()).items())
+        current = self.snapshot()
+        for kind in current.values():
+            for key in [key for key in kind if not labels <= set(key[1])]:
+                del kind[key]
+        summary = {'counters': dict(), 'timers': dict()}
+        for key, value in current['counters'].items():
+            value -= since['counters'].get(key, 0)
+            if value:
+                summary['counters'][self.__format_key(key)] = value
+        for key, (count, total) in current['timers'].items():
+            previous_count, previous_total = since['timers'].get(key, (0, 0.0))
+            count, total = count - previous_count, total - previous_total
+            if count:
+                summary['timers'][self.__format_key(key)] = {
+                    'count': count, 'total_s': round(total, 4), 'mean_ms': round(total / count * 1000, 2)}
+        return summary
+
+    def write_summary(self, filename, since=None, labels=None, **extra):
+        """
+        Writes JSON run summary.
+        :param filename. Summary file.
+        :param since. Snapshot taken at the start of the run.
+        :param labels. Only metrics with these label values are included.
+        :param extra. Additional values of summary (e.g stage timings).
+        :return nothing.
+        """
+        with open(filename, 'w') as sf:
+            json.dump(dict(self.summary(since, labels), **extra), sf, indent=1)
+
+    def __format_key(self, key):
+        """
+        Formats metric name and labels like Prometheus does (e.g name{api="gmail"}).
+        :param key. Tuple of name and labels.
+        :return str.
+        """
+        name, labels = key
+        if not labels:
+            return name
+        return name + '{' + ','.join(f'{label}="{value}"' for label, value in labels) + '}'
+
+    def prometheus(self):
+        """
+        Exports metrics in Prometheus text format. Timers are exported as summaries.
+        :return str.
+        """
+        snapshot = self.snapshot()
+        lines = list()
+        for name in sorted({name for name, _ in snapshot['counters']}):
+            lines.append(f'# TYPE {name} counter')
+            lines.extend(f'{self.__format_key(key)} {value}'
+                         for key, value in snapshot['counters'].items() if key[0] == name)
+        for name in sorted({name for name, _ in snapshot['timers']}):
+            lines.append(f'# TYPE {name} summary')
+            for (key_name, labels), (count, total) in snapshot['timers'].items():
+                if key_name == name:
+                    lines.append(f'{self.__format_key((name + "_count", labels))} {count}')
+                    lines.append(f'{self.__format_key((name + "_sum", labels))} {total}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=9108):
+        """
+        Starts Prometheus /metrics endpoint in background thread.
+        :param port. Port of the endpoint.
+        :return ThreadingHTTPServer.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                content = metrics.prometheus().encode()
+                self.send_response(200 if self.path == '/metrics' else 404)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        server = ThreadingHTTPServer(('', port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.log.info(f'Serving metrics on port {port}')
+        return server
+
+
+@contextmanager
+def profile(kind, filename='run_profile'):
+    """
+    Profiles block of code (e.g one run) with cProfile or tracemalloc.
+    cProfile stats are saved to <filename>.prof, tracemalloc top allocations to <filename>.txt.
+    Top entries are logged too.
+    :param kind. 'cprofile', 'tracemalloc' or None for no profiling.
+    :param filename. Output file name without extension.
+    """
+    log = logging.getLogger('Metrics')
+    if kind == 'cprofile':
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(f'{filename}.prof')
+            stats = pstats.Stats(profiler).sort_stats('cumulative')
+            log.info('Top functions by cumulative time: ' + ', '.join(
+                f'{function[2]} {stats.stats[function][3]:.3f}s' for function in stats.fcn_list[:10]))
+    elif kind == 'tracemalloc':
+        tracemalloc.start(10)
+        try:
+            yield
+        finally:
+            top = tracemalloc.take_snapshot().statistics('lineno')[:25]
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            with open(f'{filename}.txt', 'w') as pf:
+                pf.write(f'Peak traced memory: {peak / 2 ** 20:.1f} MiB\n')
+                pf.writelines(f'{stat}\n' for stat in top)
+            log.info(f'Peak traced memory {peak / 2 ** 20:.1f} MiB, top allocation: {top[0] if top else None}')
+    else:
+        yield
+
+
+metrics = Metrics()
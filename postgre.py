@@ -1,25 +1,38 @@
-import psycopg2 as pg2
-import re
+from contextlib import contextmanager
 from configparser import ConfigParser
 from datetime import datetime
+from decimal import Decimal
+from psycopg2 import pool
+from psycopg2.extras import execute_values
+from metrics import metrics
+from receipt_parser import Receipt, normalize_item
+
 
 class PostgreSQL:
 
 
-    def __init__(self):
+    def __init__(self, filename='database.ini', section='postgresql', minconn=1, maxconn=4):
 
-        self.params = self.__config()
-        conn = pg2.connect(**self.params)
-        cur = conn.cursor()
+        self.params = self.__config(filename, section)
+        self.pool = pool.ThreadedConnectionPool(minconn, maxconn, **self.params)
         query = '''
-                CREATE TABLE IF NOT EXISTS payments (
-                date date, 
-                amount VARCHAR(20),
-                items VARCHAR(500));
+                CREATE TABLE IF NOT EXISTS receipts (
+                id BIGSERIAL PRIMARY KEY,
+                message_id VARCHAR(64) NOT NULL UNIQUE,
+                date date NOT NULL,
+                amount NUMERIC(10, 2) NOT NULL);
+                CREATE INDEX IF NOT EXISTS receipts_date ON receipts (date);
+                CREATE TABLE IF NOT EXISTS receipt_items (
+                receipt_id BIGINT NOT NULL REFERENCES receipts (id) ON DELETE CASCADE,
+                position SMALLINT NOT NULL,
+                name VARCHAR(500) NOT NULL,
+                normalized_name VARCHAR(500) NOT NULL,
+                PRIMARY KEY (receipt_id, position));
+                ALTER TABLE receipt_items ADD COLUMN IF NOT EXISTS price NUMERIC(10, 2);
+                CREATE INDEX IF NOT EXISTS receipt_items_name ON receipt_items (normalized_name);
                 '''
-        cur.execute(query)
-        cur.close()
-        conn.commit()
+        with self.connection() as cur:
+            cur.execute(query)
 
     def __config(self, filename='database.ini', section='postgresql'):
 
@@ -31,28 +44,104 @@ class PostgreSQL:
             db[param[0]] = param[1]
         return db
 
+    @contextmanager
+    def connection(self):
+        """
+        Borrows connection from the pool for one transaction. Transaction is committed
+        when block completes and rolled back on exception.
+        :return cursor. Cursor of borrowed connection.
+        """
+        conn = self.pool.getconn()
+        try:
+            with conn:
+                with conn.cursor() as cur:
+                    yield cur
+        finally:
+            self.pool.putconn(conn)
+
+    def close(self):
+        """
+        Closes all pooled connections.
+        :return nothing.
+        """
+        self.pool.closeall()
+
     def __filter_data(self, data):
 
-        date = datetime.today().strftime('%Y-%m-%d')                                                                                                                                               
-        for receipt in data:
-            if not receipt[0] == '2019-09-30':
-                continue
-            return receipt
-            
+        date = datetime.today().strftime('%Y-%m-%d')
+        return [receipt for receipt in data if receipt[0] == date]
+
+    def __amount(self, cost):
+
+        return Decimal(cost.lstrip('-').replace(',', '.'))
+
+    def __price(self, receipt, position):
+
+        return self.__amount(receipt.prices[position]) if receipt.prices else None
+
+    def insert_receipts(self, receipts, page_size=1000):
+        """
+        Upserts provided receipts and their items with set based execute_values
+        statements in one transaction. Receipts which are already stored (same Gmail
+        message id) are skipped together with their items, so repeated runs are no-ops.
+        :param receipts. Parsed receipts (Receipt) with message id.
+        :param page_size. Number of rows sent in one INSERT statement.
+        :return int. Number of inserted receipts.
+        """
+        receipts = {receipt.message_id: receipt for receipt in receipts
+                    if receipt.cost is not None and receipt.message_id is not None}
+        with metrics.timer('db_write_seconds', table='receipts'), self.connection() as cur:
+            inserted = execute_values(cur, '''
+                INSERT INTO receipts (message_id, date, amount) VALUES %s
+                ON CONFLICT (message_id) DO NOTHING
+                RETURNING id, message_id
+                ''', [(message_id, receipt.date, self.__amount(receipt.cost))
+                       for message_id, receipt in receipts.items()],
+                page_size=page_size, fetch=True)
+            items = [(receipt_id, position, item, normalize_item(item), self.__price(receipts[message_id], position))
+                     for receipt_id, message_id in inserted
+                     for position, item in enumerate(receipts[message_id].items)]
+            execute_values(cur, '''
+                INSERT INTO receipt_items (receipt_id, position, name, normalized_name, price) VALUES %s
+                ON CONFLICT DO NOTHING
+                ''', items, page_size=page_size)
+        metrics.count('db_rows_written_total', len(inserted), table='receipts')
+        metrics.count('db_rows_written_total', len(items), table='receipt_items')
+        return len(inserted)
+
+    def get_spending(self, since, until):
+        """
+        Gets total amount spent in date range (e.g week or month).
+        :param since. First date of range (inclusive).
+        :param until. Last date of range (inclusive).
+        :return Decimal. Spent amount.
+        """
+        with metrics.timer('db_read_seconds', query='spending'), self.connection() as cur:
+            cur.execute('''SELECT COALESCE(SUM(amount), 0) FROM receipts
+                           WHERE date BETWEEN %s AND %s''', (since, until))
+            return cur.fetchone()[0]
+
+    def get_receipts(self, since=None, until=None):
+        """
+        Gets stored receipts with their items and item prices, e.g for analytics.
+        :param since. First date of range (inclusive), no limit if not provided.
+        :param until. Last date of range (inclusive), no limit if not provided.
+        :return list. Receipts (Receipt) ordered by date.
+        """
+        with metrics.timer('db_read_seconds', query='receipts'), self.connection() as cur:
+            cur.execute('''
+                SELECT r.message_id, r.date, r.amount,
+                COALESCE(array_agg(i.name ORDER BY i.position) FILTER (WHERE i.name IS NOT NULL), '{}'),
+                COALESCE(array_agg(i.price ORDER BY i.position) FILTER (WHERE i.name IS NOT NULL), '{}')
+                FROM receipts r LEFT JOIN receipt_items i ON i.receipt_id = r.id
+                WHERE (%(since)s IS NULL OR r.date >= %(since)s) AND (%(until)s IS NULL OR r.date <= %(until)s)
+                GROUP BY r.id ORDER BY r.date
+                ''', {'since': since, 'until': until})
+            rows = cur.fetchall()
+        return [Receipt(date.isoformat(), f'-{amount}'.replace('.', ','), names, message_id,
+                        [None if price is None else str(price).replace('.', ',') for price in prices])
+                for message_id, date, amount, names, prices in rows]
+
     def insert_data(self, data):
 
-        conn = pg2.connect(**self.params)
-        cur = conn.cursor()
-        values = self.__filter_data(data)
-        date = values[0]
-        amount = values[1].replace(',','.')
-        for item in values[2]:
-            m = re.match('^([^.])\D*', item).group(0).lower()
-            query = f'''
-            INSERT INTO payments(date, amount, items)
-            VALUES(to_date('{date}', 'YYYY-MM-DD'), {amount}, '{m}');
-            '''
-            cur.execute(query)
-        query = '''SELECT * FROM payments'''
-        cur.execute(query)
-        cur.fetchall()
+        return self.insert_receipts(self.__filter_data(data))
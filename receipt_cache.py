@@ -0,0 +1,105 @@
+import sqlite3
+import json
+import time
+import logging
+import threading
+
+
+class ReceiptCache:
+    """
+    Stores parsed receipts on disk by Gmail message id, so already parsed
+    messages are not downloaded and parsed again by next runs. Cache is used from
+    scheduler and worker threads, so one connection is shared under a lock.
+    """
+
+    def __init__(self, parser_version, filename=None, max_age_days=400, max_entries=50000, account=None,
+                 evict_interval=3600):
+        """
+        Opens (or creates) cache database and evicts stale entries. Stale entries are evicted
+        again by put_many() at most once per evict interval. Every account has its own
+        database, because message ids are unique only within one mailbox.
+        :param parser_version. Version of receipt parsing rules. Entries parsed by other version are dropped.
+        :param filename. SQLite database file, receipts_cache.sqlite (receipts_cache_<account>.sqlite
+        for named account) if not provided.
+        :param max_age_days. Entries older than this are evicted.
+        :param max_entries. Maximum number of cached messages, oldest entries are evicted first.
+        :param account. Account name which selects database file. None for default account.
+        :param evict_interval. Minimum seconds between evictions.
+        """
+        self.log = logging.getLogger('ReceiptCache')
+        self.parser_version = parser_version
+        self.max_age = max_age_days * 24 * 3600
+        self.max_entries = max_entries
+        self.evict_interval = evict_interval
+        self.evicted = 0
+        self.lock = threading.Lock()
+        filename = filename or (f'receipts_cache_{account}.sqlite' if account else 'receipts_cache.sqlite')
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS receipts (
+            message_id TEXT PRIMARY KEY,
+            parser_version INTEGER NOT NULL,
+            created REAL NOT NULL,
+            receipt TEXT);
+            ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS receipts_created ON receipts (created)')
+        self.evict()
+
+    def evict(self):
+        """
+        Removes entries of other parser versions, entries older than max age
+        and oldest entries above max entries count.
+        :return nothing.
+        """
+        with self.lock, self.conn:
+            self.evicted = time.time()
+            self.conn.execute('DELETE FROM receipts WHERE parser_version != ? OR created < ?',
+                              (self.parser_version, time.time() - self.max_age))
+            self.conn.execute('''
+                DELETE FROM receipts WHERE message_id IN (
+                SELECT message_id FROM receipts ORDER BY created DESC LIMIT -1 OFFSET ?)
+                ''', (self.max_entries,))
+
+    def get_many(self, message_ids):
+        """
+        Gets cached receipts of provided messages.
+        :param message_ids. List of Gmail message ids.
+        :return dict. Message id to receipt (None if message is not a receipt) for cached messages only.
+        """
+        cached = dict()
+        message_ids = list(message_ids)
+        for start in range(0, len(message_ids), 500):
+            chunk = message_ids[start:start + 500]
+            with self.lock:
+                rows = self.conn.execute(
+                    f'SELECT message_id, receipt FROM receipts WHERE parser_version = ? '
+                    f'AND message_id IN ({",".join("?" * len(chunk))})', [self.parser_version] + chunk).fetchall()
+            for message_id, receipt in rows:
+                cached[message_id] = json.loads(receipt)
+        self.log.debug('Cache hits %d of %d', len(cached), len(message_ids))
+        return cached
+
+    def put_many(self, receipts):
+        """
+        Stores parsed receipts. Stale entries are evicted if evict interval passed since last eviction,
+        so limits are kept in long running processes too.
+        :param receipts. Dictionary of message id to receipt (None if message is not a receipt).
+        :return nothing.
+        """
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO receipts VALUES (?, ?, ?, ?)',
+                                  [(message_id, self.parser_version, now, json.dumps(receipt))
+                                   for message_id, receipt in receipts.items()])
+        if now - self.evicted > self.evict_interval:
+            self.evict()
+
+    def receipts(self):
+        """
+        Gets all cached receipts.
+        :return list. Cached receipts, oldest cached first.
+        """
+        with self.lock:
+            rows = self.conn.execute('SELECT receipt FROM receipts WHERE parser_version = ? AND receipt != ? '
+                                     'ORDER BY created', (self.parser_version, 'null')).fetchall()
+        return [json.loads(receipt) for receipt, in rows]
@@ -0,0 +1,115 @@
+import re
+import html
+import base64
+from email import message_from_bytes, policy
+from email.parser import BytesHeaderParser
+from collections import namedtuple
+
+# Increase when parsing rules change, so cached receipts are parsed again.
+PARSER_VERSION = 4
+
+Receipt = namedtuple('Receipt', ['date', 'cost', 'items', 'message_id', 'prices'], defaults=[None, None])
+
+HEADER_END = re.compile(rb'\r?\n\r?\n')
+PRE_BLOCK = re.compile(r'<pre\b[^>]*>(.*?)</pre\s*>', re.IGNORECASE | re.DOTALL)
+ITEM_NAME = re.compile(r'^([^.])\D*')
+
+
+def normalize_item(item):
+    """
+    Trims item name to product name without weights, volumes and other numbers.
+    :param item. Item name from receipt (e.g Pienas ROKIŠKIO 2,5% 1L).
+    :return str. Lowercase product name (e.g 'pienas rokiškio ').
+    """
+    match = ITEM_NAME.match(item)
+    return (match.group(0) if match else item).lower()
+
+
+def find_receipt_block(payload):
+    """
+    Scans HTML part for <pre> blocks without building a document tree.
+    Maxima receipt text is placed in the second <pre> block.
+    :param payload. HTML part of the email message (str).
+    :return str. Text of receipt block or None if message has no receipt block.
+    """
+    blocks = PRE_BLOCK.finditer(payload)
+    next(blocks, None)
+    block = next(blocks, None)
+    if block is None:
+        return None
+    return html.unescape(block.group(1))
+
+
+def parse_lines(lines):
+    """
+    Parses receipt text lines to purchase date, cost and purchased items.
+    Item name may be split in several lines, in such case item line
+    (which ends with tax group ' A') is joined with previous line.
+    :param lines. List of receipt lines. Second to last line contains purchase date.
+    :return Receipt. Parsed receipt with item prices (e.g 0,89).
+    """
+    date = '-'.join(lines[-2].split()[3:6])
+    cost = None
+    items = list()
+    prices = list()
+    last_item = ''
+    for line in lines:
+        if line.find('Mokėti') != -1:
+            cost = '-' + line.split()[-1]
+        elif not line.endswith(' A'):
+            last_item = line
+        elif line.startswith('Nuolaida'):
+            continue
+        else:
+            line = (last_item + ' ' + line).split()
+            items.append(' '.join(line[:-2]))
+            prices.append(line[-2])
+            last_item = ''
+    return Receipt(date, cost, items, prices=prices)
+
+
+def parse_receipt(payload):
+    """
+    Parses HTML part of Maxima receipt email.
+    :param payload. HTML part of the email message (str).
+    :return Receipt. Parsed receipt or None if HTML has no receipt block.
+    """
+    block = find_receipt_block(payload)
+    if block is None:
+        return None
+    # Text on the opening tag line is skipped and the closing tag is kept as the last line,
+    # the same way as in BeautifulSoup based parser, so the date is on the second to last line.
+    lines = (block + '</pre>').splitlines()[1:]
+    if len(lines) < 2:
+        return None
+    return parse_lines(lines)
+
+
+def parse_raw_message(msg, sender):
+    """
+    Decodes raw Gmail message and parses receipt from its HTML part if message
+    was sent by provided sender. Message bytes are parsed directly (without decoding
+    whole message to str) with compat32 policy, which does not build header objects.
+    Headers are parsed first, so body of other senders messages is never parsed.
+    Module level function, so it can be used by process pool.
+    :param msg. Gmail message downloaded with format='raw'.
+    :param sender. Email address of receipt sender.
+    :return Receipt. Parsed receipt with message id or None if message is not a receipt.
+    """
+    raw = base64.urlsafe_b64decode(msg['raw'])
+    header_end = HEADER_END.search(raw)
+    headers = BytesHeaderParser(policy=policy.compat32).parsebytes(raw[:header_end.end() if header_end else None])
+    try:
+        sender_email = re.search('<(.*)>', headers['from']).group(1)
+    except (AttributeError, TypeError):
+        return None
+
+    if sender_email != sender:
+        return None
+    for part in message_from_bytes(raw, policy=policy.compat32).walk():
+        if part.get_content_type() == 'text/html':
+            payload = part.get_payload(decode=True)
+            receipt = parse_receipt(payload.decode(part.get_content_charset() or 'utf-8', errors='replace'))
+            if receipt is not None:
+                return receipt._replace(message_id=msg['id'])
+    return None
@@ -0,0 +1,118 @@
+import time
+import random
+import logging
+import threading
+import socket
+from googleapiclient import errors
+from metrics import metrics
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter. Tokens are added at constant rate up to capacity,
+    every request takes tokens of its quota cost.
+    """
+
+    def __init__(self, rate, capacity):
+        """
+        :param rate. Tokens added per second.
+        :param capacity. Maximum number of tokens (allowed burst).
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, cost=1):
+        """
+        Waits until bucket has enough tokens and takes them. Request which costs more than
+        bucket capacity waits for full bucket and leaves it in debt, so following requests wait.
+        :param cost. Quota cost of the request.
+        :return float. Seconds waited.
+        """
+        waited = 0
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                required = min(cost, self.capacity)
+                if self.tokens >= required:
+                    self.tokens -= cost
+                    return waited
+                delay = (required - self.tokens) / self.rate
+                time.sleep(delay)
+                waited += delay
+
+
+class RequestExecutor:
+    """
+    Executes every Google API request. Requests are rate limited by per API token
+    buckets, number of requests in flight is capped and requests which failed with
+    quota or server errors are retried with jittered exponential backoff.
+    """
+
+    # (quota units per second, burst) per user. Burst plus units added during one quota
+    # window must not exceed published per user quota, full bucket is spent at once at start
+    QUOTAS = {
+        'gmail': (200, 50),  # 250 quota units per second
+        'sheets': (0.9, 6),  # 60 requests per minute
+        'drive': (20, 100),  # 12 000 requests per minute
+    }
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, max_in_flight=8, max_retries=6, max_backoff=64, quotas=None):
+        """
+        :param max_in_flight. Maximum number of requests executed at the same time.
+        :param max_retries. How many times failed request is retried.
+        :param max_backoff. Maximum wait between retries in seconds.
+        :param quotas. Dictionary of API name to (rate, burst), QUOTAS if not provided.
+        """
+        self.log = logging.getLogger('RequestExecutor')
+        self.buckets = {api: TokenBucket(rate, capacity)
+                        for api, (rate, capacity) in (quotas or self.QUOTAS).items()}
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+
+    def __retryable(self, error, idempotent):
+        """
+        Checks whether request failed with error which is worth retrying. Non-idempotent
+        request is retried only when it was rejected by rate limit, because after server
+        error or timeout it may have been done already.
+        :param error. Exception raised by request.
+        :param idempotent. Whether request can be repeated safely.
+        :return bool.
+        """
+        if isinstance(error, errors.HttpError):
+            return error.resp.status in (self.RETRY_STATUSES if idempotent else (429,))
+        return idempotent and isinstance(error, (socket.timeout, ConnectionError))
+
+    def execute(self, api, request, cost=1, idempotent=True):
+        """
+        Executes request when rate limit allows it, retrying failed requests.
+        :param api. Service name (e.g gmail), selects rate limiter.
+        :param request. HttpRequest or BatchHttpRequest.
+        :param cost. Quota cost of the request (e.g 5 for Gmail messages.get).
+        :param idempotent. False for requests which must not be repeated (e.g sending email).
+        :return Response of the request.
+        """
+        method = getattr(request, 'methodId', None) or 'batch'
+        for attempt in range(self.max_retries + 1):
+            metrics.observe('api_rate_limit_wait_seconds', self.buckets[api].acquire(cost), api=api)
+            try:
+                with self.in_flight, metrics.timer('api_request_seconds', api=api, method=method):
+                    response = request.execute()
+                metrics.count('api_requests_total', api=api, method=method, status='ok')
+                metrics.count('api_quota_units_total', cost, api=api)
+                return response
+            except Exception as error:
+                status = error.resp.status if isinstance(error, errors.HttpError) else type(error).__name__
+                metrics.count('api_requests_total', api=api, method=method, status=status)
+                if attempt == self.max_retries or not self.__retryable(error, idempotent):
+                    raise
+                metrics.count('api_retries_total', api=api, method=method)
+                delay = random.uniform(0, min(self.max_backoff, 2 ** attempt))
+                self.log.warning('%s request failed (%s), retrying in %.1f seconds', api, error, delay)
+                time.sleep(delay)
@@ -0,0 +1,67 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from google_clients import clients as shared_clients
+from sheet_layout import LayoutIndex
+from main import MainApp
+from scheduler import CronSchedule, Scheduler
+
+
+class AccountRunner:
+    """
+    Runs daily sequence of several accounts (mailbox, spreadsheet and recipient profiles)
+    on one shared worker pool. Accounts share service client manager, request executor
+    and sheet layout index, while tokens, sync state and failures stay per account.
+    """
+
+    def __init__(self, config='accounts.json', workers=4, use_async=False):
+        """
+        Loads account profiles and initiates application of every account.
+        :param config. JSON file with start_time and list of accounts
+        (name, spreadsheet_id, sender, recipient).
+        :param workers. Number of accounts processed at the same time.
+        :param use_async. Run independent I/O stages of every account concurrently with asyncio.
+        """
+        self.log = logging.getLogger('AccountRunner')
+        with open(config, 'r') as cf:
+            config = json.load(cf)
+        self.start_time = config['start_time']
+        self.workers = workers
+        layout_index = LayoutIndex()
+        self.apps = dict()
+        for profile in config['accounts']:
+            self.apps[profile['name']] = MainApp(self.start_time, use_async, account=profile['name'],
+                                                 spreadsheet_id=profile['spreadsheet_id'],
+                                                 sender=profile['sender'], recipient=profile['recipient'],
+                                                 clients=shared_clients, layout_index=layout_index)
+        self.log.info(f'Loaded {len(self.apps)} accounts')
+
+    def run_once(self):
+        """
+        Runs daily sequence of every account on worker pool. Failure of one account
+        is logged and does not stop other accounts.
+        :return dict. Account name to True if run succeeded.
+        """
+        results = dict()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(app.run_once): name for name, app in self.apps.items()}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    future.result()
+                    results[name] = True
+                except Exception:
+                    self.log.exception(f'Run of account {name} failed')
+                    results[name] = False
+        return results
+
+    def start(self, wait=True, cron=None):
+        """
+        Starts one scheduler which runs all accounts at start time (or by cron expression).
+        :param wait. Boolean indicating whether wait for start time or run immediately first.
+        :param cron. Cron expression which replaces daily start time.
+        :return nothing.
+        """
+        schedule = CronSchedule(cron) if cron else CronSchedule.daily(self.start_time)
+        self.scheduler = Scheduler(self.run_once, schedule, name='accounts')
+        self.scheduler.start(run_now=wait is False)
@@ -0,0 +1,237 @@
+import os.path
+import json
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+
+
+class CronSchedule:
+    """
+    Cron-like schedule: minute, hour, day of month, month and day of week fields.
+    Fields support *, lists (1,15), ranges (1-5) and steps (*/10, 0-30/5).
+    Day of week is 0-6 starting from Sunday (7 is Sunday too).
+    """
+
+    FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expression):
+        """
+        :param expression. Cron expression (e.g '25 22 * * *').
+        """
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f'Cron expression must have 5 fields: {expression}')
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            self.__parse(field, low, high) for field, (low, high) in zip(fields, self.FIELDS)]
+        if 7 in self.weekdays:
+            self.weekdays.add(0)
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @classmethod
+    def daily(cls, start_time):
+        """
+        Creates schedule which runs every day at specified time.
+        :param start_time. Time of the day (e.g 22:25:00), seconds are ignored.
+        :return CronSchedule.
+        """
+        h, m = start_time.split(':')[:2]
+        return cls(f'{int(m)} {int(h)} * * *')
+
+    def __parse(self, field, low, high):
+        """
+        Parses one cron field.
+        :param field. Field expression.
+        :param low. Lowest allowed value.
+        :param high. Highest allowed value.
+        :return set. Allowed values.
+        """
+        values = set()
+        for part in field.split(','):
+            part, _, step = part.partition('/')
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = map(int, part.split('-'))
+            else:
+                start = end = int(part)
+                if step:
+                    end = high
+            if not low <= start <= end <= high:
+                raise ValueError(f'Cron field {field} is out of range {low}-{high}')
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def __day_matches(self, moment):
+        """
+        Checks day of month and day of week fields. When both are restricted,
+        day matches if any of them matches, same as in cron.
+        :param moment. datetime.
+        :return bool.
+        """
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def next_after(self, moment):
+        """
+        Finds the first scheduled time after provided time.
+        :param moment. datetime.
+        :return datetime. Next scheduled time.
+        """
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=5 * 366)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0)
+            elif not self.__day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f'Cron expression {self.expression} never matches')
+
+
+class Scheduler:
+    """
+    Runs job by schedule. Next run time is taken from schedule, not from the end of previous
+    run, so slow runs do not move the schedule. Runs never overlap, runs missed while
+    process was stopped or previous run was still running are caught up once.
+    In watch mode job is also triggered as soon as watch function reports new data.
+    """
+
+    def __init__(self, job, schedule, name='job', catch_up=True, watch=None, poll_interval=300):
+        """
+        :param job. Function which is run.
+        :param schedule. CronSchedule.
+        :param name. Job name, used for state file scheduler_state_<name>.json.
+        :param catch_up. Run once immediately if scheduled runs were missed.
+        :param watch. Function which returns True when job should run now (e.g new receipts arrived).
+        :param poll_interval. Seconds between watch function calls.
+        """
+        self.log = logging.getLogger('Scheduler')
+        self.job = job
+        self.schedule = schedule
+        self.name = name
+        self.catch_up = catch_up
+        self.watch = watch
+        self.poll_interval = poll_interval
+        self.state_file = f'scheduler_state_{name}.json'
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.state = {'last_run': None, 'last_duration': None}
+        if os.path.exists(self.state_file):
+            with open(self.state_file, 'r') as sf:
+                self.state = json.load(sf)
+
+    def __save_state(self):
+        """
+        Saves time of the last scheduled run and its duration.
+        :return nothing.
+        """
+        with open(self.state_file, 'w') as sf:
+            json.dump(self.state, sf)
+
+    def run(self, scheduled=None):
+        """
+        Runs job unless it is already running.
+        :param scheduled. Scheduled time of the run, None for triggered runs.
+        :return bool. True if job was run.
+        """
+        if not self.lock.acquire(blocking=False):
+            self.log.warning(f'{self.name} is still running, skipping run')
+            return False
+        started = time.perf_counter()
+        try:
+            self.job()
+        except Exception:
+            self.log.exception(f'{self.name} run failed')
+        finally:
+            duration = time.perf_counter() - started
+            self.state['last_duration'] = duration
+            if scheduled is not None:
+                self.state['last_run'] = scheduled.isoformat()
+            self.__save_state()
+            self.lock.release()
+            self.log.info(f'{self.name} run took {duration:.2f}s')
+        return True
+
+    def __following(self, scheduled):
+        """
+        Gets next run time after the run scheduled at provided time. If next runs were
+        missed, one catch up run is scheduled immediately.
+        :param scheduled. Scheduled time of the previous run.
+        :return datetime.
+        """
+        following = self.schedule.next_after(scheduled)
+        now = datetime.now()
+        if following <= now:
+            self.log.info(f'{self.name} missed run at {following}')
+            following = now if self.catch_up else self.schedule.next_after(now)
+        return following
+
+    def run_forever(self):
+        """
+        Runs job by schedule until stop() is called.
+        :return nothing.
+        """
+        if self.state['last_run'] is not None:
+            next_run = self.__following(datetime.fromisoformat(self.state['last_run']))
+        else:
+            next_run = self.schedule.next_after(datetime.now())
+        self.log.info(f'{self.name} next run at {next_run}')
+        while not self.stopped.is_set():
+            wait = (next_run - datetime.now()).total_seconds()
+            if wait <= 0:
+                self.run(next_run)
+                next_run = self.__following(next_run)
+                self.log.info(f'{self.name} next run at {next_run}')
+                continue
+            if self.watch is not None:
+                wait = min(wait, self.poll_interval)
+            if self.stopped.wait(wait):
+                break
+            if self.watch is not None and datetime.now() < next_run and self.__watch():
+                self.run()
+
+    def __watch(self):
+        """
+        Calls watch function, errors are logged and treated as no new data.
+        :return bool.
+        """
+        try:
+            return self.watch()
+        except Exception:
+            self.log.exception(f'{self.name} watch failed')
+            return False
+
+    def start(self, run_now=False):
+        """
+        Starts scheduler in background thread.
+        :param run_now. Run job immediately before waiting for schedule. This run is the
+        catch up run: it is recorded as last run, so missed runs are not run once more.
+        :return nothing.
+        """
+        def target():
+            if run_now:
+                self.run(datetime.now())
+            self.run_forever()
+        self.thread = threading.Thread(target=target, name=f'scheduler-{self.name}')
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops scheduler after current run completes.
+        :return nothing.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
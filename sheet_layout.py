@@ -0,0 +1,55 @@
+import os.path
+import json
+import logging
+import threading
+
+
+class LayoutIndex:
+    """
+    Stores layout of month sheets (sheet id, week date rows and weekly balance table)
+    between runs, so unchanged sheets do not have to be read again. One index can be
+    shared by several accounts.
+    """
+
+    def __init__(self, filename='sheet_layout.json'):
+        """
+        Loads saved layouts.
+        :param filename. File where layouts are stored.
+        """
+        self.log = logging.getLogger('LayoutIndex')
+        self.filename = filename
+        self.layouts = dict()
+        self.lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename, 'r') as lf:
+                self.layouts = json.load(lf)
+
+    def get(self, spreadsheet_id, title, revision):
+        """
+        Gets saved layout of the sheet if spreadsheet was not changed since layout was saved.
+        :param spreadsheet_id. Spreadsheet id.
+        :param title. Sheet title (e.g 2019-11).
+        :param revision. Current spreadsheet revision, None if unknown.
+        :return dict. Sheet layout or None if it is not saved or outdated.
+        """
+        layout = self.layouts.get(f'{spreadsheet_id}/{title}')
+        if revision is None or layout is None or layout['revision'] != revision:
+            self.log.debug('No valid layout for %s', title)
+            return None
+        return layout
+
+    def put(self, spreadsheet_id, title, revision, layout):
+        """
+        Saves layout of the sheet.
+        :param spreadsheet_id. Spreadsheet id.
+        :param title. Sheet title (e.g 2019-11).
+        :param revision. Spreadsheet revision which layout belongs to.
+        :param layout. Dictionary with sheet_id, week_dates and weeks.
+        :return nothing.
+        """
+        if revision is None:
+            return
+        with self.lock:
+            self.layouts[f'{spreadsheet_id}/{title}'] = dict(layout, revision=revision)
+            with open(self.filename, 'w') as lf:
+                json.dump(self.layouts, lf)
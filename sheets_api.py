@@ -1,14 +1,14 @@
 from __future__ import print_function
-import pickle
-import os.path
 import logging
-import logging.config
 import json
 from datetime import datetime
+from itertools import groupby
+from collections import defaultdict
 from string import ascii_uppercase
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
+from googleapiclient import errors
+from google_clients import clients as shared_clients
+from sheet_layout import LayoutIndex
+from metrics import metrics
 
 
 class SheetsApi:
@@ -16,48 +16,43 @@ class SheetsApi:
     Initiates Google Sheets API which adds values and notes to specified cells.
     """
 
-    def __init__(self):
+    LAYOUT_RANGES = ('H3:N24', 'B19:E22')
+    MAX_BATCH_REQUESTS = 500
+    MAX_BATCH_BYTES = 1024 * 1024
+
+    SPREADSHEET_ID = '1eeWDcQ63Bsz6CU1PBcJ8_wKC4h5xpPhBHEpe1SOqyRg'
+
+    def __init__(self, clients=None, account=None, spreadsheet_id=None, layout_index=None):
         """
-        Loads logging configuration file.
         Start Sheets API initiation process.
+        :param clients. ClientManager which provides service clients, shared one if not provided.
+        :param account. Account name which selects token of the account. None for default account.
+        :param spreadsheet_id. Spreadsheet where receipts are written, SPREADSHEET_ID if not provided.
+        :param layout_index. LayoutIndex, it can be shared between accounts.
         """
-        with open('logging.conf', 'r') as lc:
-            log = json.load(lc)
-            logging.config.dictConfig(log)
+        self.account = account
+        self.spreadsheet_id = spreadsheet_id or self.SPREADSHEET_ID
+        self.clients = clients or shared_clients
+        self.executor = self.clients.executor
         self.log = logging.getLogger('SheetsApi')
+        self.layout_index = layout_index or LayoutIndex()
+        self.cell_and_number = None
         self.__init_api()
 
     def __init_api(self):
         """
-        Configures service API which is defined by variable api
-        :param str api. Service name
-        :return service. Instance of configured service (gmail or sheets)
+        Gets service client of API which is defined by variable api from shared client manager.
+        :return nothing.
         """
         api = 'sheets'
-        SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
-        self.spreadsheet_id = '1eeWDcQ63Bsz6CU1PBcJ8_wKC4h5xpPhBHEpe1SOqyRg'
+        SCOPES = ['https://www.googleapis.com/auth/spreadsheets',
+                  'https://www.googleapis.com/auth/drive.metadata.readonly']
         version = 'v4'
 
-        creds = None
-        # The file token.pickle stores the user's access and refresh tokens, and is
-        # created automatically when the authorization flow completes for the first
-        # time.
-        if os.path.exists(f'creds/token_{api}.pickle'):
-            with open(f'creds/token_{api}.pickle', 'rb') as token:
-                creds = pickle.load(token)
-        # If there are no (valid) credentials available, let the user log in.
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    f'creds/credentials_{api}.json', SCOPES)
-                creds = flow.run_local_server(port=0)
-            # Save the credentials for the next run
-            with open(f'creds/token_{api}.pickle', 'wb') as token:
-                pickle.dump(creds, token)
-
-        self.service = build(api, version, credentials=creds)
+        token = f'{api}_{self.account}' if self.account else api
+        self.service = self.clients.service(api, version, token, SCOPES, secrets=api)
+        # Drive API is only used for reading spreadsheet revision
+        self.drive = self.clients.service('drive', 'v3', token, SCOPES, secrets=api)
         self.log.debug(f'Setup completed with {api}')
 
     def __get_current_dates(self):
@@ -74,30 +69,71 @@ class SheetsApi:
         selected sheet. This method get current sheet by finding correct month.
         :return str
         """
-        sheet_metadata = self.service.spreadsheets().get(spreadsheetId=self.spreadsheet_id).execute()
-        sheets = sheet_metadata.get('sheets', '')
-        month = datetime.today().strftime('%Y-%m')
-        for i in range(len(sheets[1].get("properties", {}).get("title", "Sheet1"))):
-            title = sheets[i].get("properties", {}).get("title", "Sheet1")
-            if title == self.month:
-                return sheets[i].get('properties', {}).get('sheetId',0)
+        sheet_metadata = self.executor.execute('sheets', self.service.spreadsheets().get(
+            spreadsheetId=self.spreadsheet_id, fields='sheets.properties'))
+        for sheet in sheet_metadata.get('sheets', []):
+            if sheet.get("properties", {}).get("title", "Sheet1") == self.month:
+                return sheet.get('properties', {}).get('sheetId', 0)
+
+    def __get_revision(self):
+        """
+        Gets spreadsheet revision number from Drive API. It changes on every spreadsheet edit.
+        :return str. Revision number or None if it could not be read (e.g token without Drive scope).
+        """
+        try:
+            return self.executor.execute('drive', self.drive.files().get(fileId=self.spreadsheet_id,
+                                                                         fields='version')).get('version')
+        except errors.HttpError as error:
+            self.log.warning(f'Could not get spreadsheet revision: {error}')
+            return None
+
+    def __load_layout(self):
+        """
+        Loads current month sheet layout from layout index. If spreadsheet was changed
+        since layout was saved, layout and sheet id are read from Sheets API.
+        :return bool. True if layout was read from Sheets API.
+        """
+        layout = self.layout_index.get(self.spreadsheet_id, self.month, self.__get_revision())
+        metrics.count('sheet_layout_loads_total', source='index' if layout is not None else 'api')
+        if layout is not None:
+            self.sheet_id, self.week_dates, self.weeks = layout['sheet_id'], layout['week_dates'], layout['weeks']
+            return False
+        self.__read_layout()
+        self.sheet_id = self.__get_sheet_id()
+        return True
+
+    def __save_layout(self):
+        """
+        Saves current month sheet layout with spreadsheet revision after this run changes.
+        :return nothing.
+        """
+        layout = {'sheet_id': self.sheet_id, 'week_dates': self.week_dates, 'weeks': self.weeks}
+        self.layout_index.put(self.spreadsheet_id, self.month, self.__get_revision(), layout)
 
-    def __loop_through(self, service):
+    def __read_layout(self):
         """
-        By specified service goes to spreadsheet cell until finds a match
-        of cell value and current date. Then that cell value is returned.
-        :param service: Google Sheets API service instance
+        Reads week date rows (H3:N24) and weekly balance table (B19:E22) of current
+        month sheet with one batchGet request. Cells are then matched in memory.
+        :return nothing.
+        """
+        ranges = [f'{self.month}!{cell_range}' for cell_range in self.LAYOUT_RANGES]
+        result = self.executor.execute('sheets', self.service.spreadsheets().values().batchGet(
+            spreadsheetId=self.spreadsheet_id, ranges=ranges))
+        self.week_dates, self.weeks = [value_range.get('values', []) for value_range in result.get('valueRanges', [])]
+
+    def __loop_through(self):
+        """
+        Goes through week date rows until finds a match of cell value
+        and current date. Then that cell is returned.
         :return: cell. Cell which matches with todays date.
         """
-        self.month = '2019-11'
         for number in [3, 10, 17, 24]:  # Week rows
-            for letter in ascii_uppercase[7:14]:  # Range from H to N
-                cell = f'{letter}{number}'
-                result = self.service.spreadsheets().values().get(spreadsheetId=self.spreadsheet_id,
-                                                             range=f'{self.month}!{cell}').execute()
-                date_in_spreadsheet = result.get('values', [])
-                if date_in_spreadsheet[0][0] == self.date:
-                    self.log.debug(f'Got cell {cell}')
+            index = number - 3
+            row = self.week_dates[index] if index < len(self.week_dates) else []
+            for letter, value in zip(ascii_uppercase[7:14], row):  # Range from H to N
+                if value == self.date:
+                    cell = f'{letter}{number}'
+                    self.log.debug('Got cell %s', cell)
                     return cell
 
     def __increase_cell_number(self, cell, number):
@@ -125,91 +161,189 @@ class SheetsApi:
                 endColumnIndex = number + 1
                 startRowIndex = int(''.join(cell_splitted[1:])) - 1
                 endRowIndex = int(''.join(cell_splitted[1:]))
-                self.log.debug(f'Got cell range: startRowIndex {startRowIndex}, endRowIndex {endRowIndex}')
-                self.log.debug(f'startColumnIndex {startColumnIndex}, endColumnIndex {endColumnIndex}')
+                self.log.debug('Got cell range: startRowIndex %d, endRowIndex %d, startColumnIndex %d, '
+                               'endColumnIndex %d', startRowIndex, endRowIndex, startColumnIndex, endColumnIndex)
                 return startRowIndex, endRowIndex, startColumnIndex, endColumnIndex
     
-    def __update_sheet(self, body, c_range=None):
+    def __cell_value(self, value):
+        """
+        Converts receipt cost (e.g -12,34) to cell value, the same way as USER_ENTERED input would.
+        :param value. Cost in string.
+        :return dict. Sheets API ExtendedValue.
+        """
+        try:
+            return {'numberValue': float(value.replace(',', '.'))}
+        except ValueError:
+            return {'stringValue': value}
+
+    def __queue_cell(self, cell, value=None, note=None):
+        """
+        Adds cell value and/or note change to write buffer. Changes are sent by __flush() method.
+        :param cell. Sheet cell in string.
+        :param value. Cost in string which should be entered to cell.
+        :param note. Note text which should be added to cell.
+        :return nothing.
+        """
+        startRowIndex, endRowIndex, startColumnIndex, endColumnIndex = self.__get_cell_range(cell)
+        data, fields = dict(), list()
+        if value is not None:
+            data['userEnteredValue'] = self.__cell_value(value)
+            fields.append('userEnteredValue')
+        if note is not None:
+            data['note'] = note
+            fields.append('note')
+        if not fields:
+            return
+        self.requests.append({
+            "updateCells": {
+                "range": {
+                    "sheetId": self.sheet_id,
+                    "startRowIndex": startRowIndex,
+                    "endRowIndex": endRowIndex,
+                    "startColumnIndex": startColumnIndex,
+                    "endColumnIndex": endColumnIndex,
+                },
+                "rows": [{"values": [data]}],
+                "fields": ','.join(fields),
+            }
+        })
+
+    def __flush(self):
         """
-        Updating spreadsheet cel y specified body param. 
-        :param body. Dictionary with specifies sheets API whether to update values or add note to cell.
-        :param c_range. String which specifies on which cell should values be updated.
+        Sends buffered cell changes with spreadsheets().batchUpdate. Requests are split to
+        several batchUpdate calls when there are more than MAX_BATCH_REQUESTS of them or
+        payload exceeds MAX_BATCH_BYTES.
         :return nothing.
         """
-        if c_range is not None:
-            self.log.debug(f'Entering receipt price to cell - {c_range}')
-            self.service.spreadsheets().values().update(spreadsheetId=self.spreadsheet_id,
-                range=c_range, valueInputOption='USER_ENTERED', body=body).execute()
-        else:
-            self.log.debug('Entering note to cell')
-            self.service.spreadsheets().batchUpdate(spreadsheetId=self.spreadsheet_id, body=body).execute()
+        chunk, size = list(), 0
+        for request in self.requests:
+            request_size = len(json.dumps(request))
+            if chunk and (len(chunk) >= self.MAX_BATCH_REQUESTS or size + request_size > self.MAX_BATCH_BYTES):
+                self.__update_sheet(chunk)
+                chunk, size = list(), 0
+            chunk.append(request)
+            size += request_size
+        if chunk:
+            self.__update_sheet(chunk)
+        self.requests = list()
+
+    def __update_sheet(self, requests):
+        """
+        Updating spreadsheet cells by specified requests.
+        :param requests. List of Sheets API batchUpdate requests.
+        :return nothing.
+        """
+        self.log.debug('Sending %d cell updates', len(requests))
+        metrics.count('sheet_cells_written_total', len(requests))
+        self.executor.execute('sheets', self.service.spreadsheets().batchUpdate(
+            spreadsheetId=self.spreadsheet_id, body={'requests': requests}))
 
     def get_weekly_balance(self):
         """
-        Gets weekly balance from spreadsheet. Finds week start date and week end date compares it with
-        todays date. Day specifies which row to select for correct weekly balance.
+        Gets weekly balance from spreadsheet. Week start date and week end date read by write_to_sheet
+        are compared with todays date. Day specifies which row to select for correct weekly balance.
         :return str. Weekly balance.
         """
         
         current_date = datetime.strptime(self.date, '%Y-%m-%d')
-        for row in [19, 20, 21, 22]:
-            w_start = self.service.spreadsheets().values().get(spreadsheetId=self.spreadsheet_id,
-                                                            range=f'{self.month}!B{row}').execute()
-            w_end = self.service.spreadsheets().values().get(spreadsheetId=self.spreadsheet_id,
-                                                            range=f'{self.month}!C{row}').execute()
-
-            w_start = datetime.strptime(w_start.get('values')[0][0], "%Y-%m-%d")
-            w_end = datetime.strptime(w_end.get('values')[0][0], "%Y-%m-%d")
+        for row, week in zip([19, 20, 21, 22], self.weeks):
+            if len(week) < 2:
+                continue
+            w_start = datetime.strptime(week[0], "%Y-%m-%d")
+            w_end = datetime.strptime(week[1], "%Y-%m-%d")
             if w_start <= current_date <= w_end:
                 cell = f'{self.month}!E{row}'
-        balance = self.service.spreadsheets().values().get(spreadsheetId=self.spreadsheet_id,
-                                                            range=cell).execute().get('values')
+        balance = self.executor.execute('sheets', self.service.spreadsheets().values().get(
+            spreadsheetId=self.spreadsheet_id, range=cell)).get('values')
         return balance[0][0].replace(' ','')
 
+    def prepare(self):
+        """
+        Loads current month sheet layout and finds the cell where todays receipts are written.
+        Called by write_to_sheet() if it was not called before.
+        :return nothing.
+        """
+        self.__get_current_dates()
+        self.read_layout = self.__load_layout()
+        cell_range = self.__loop_through()  # Find week
+        self.cell_and_number = self.__increase_cell_number(cell_range, 2)  # Find start position
+        self.requests = list()
+
+    def add_receipt(self, receipt):
+        """
+        Adds receipt to write buffer. If receipt date do not match current date - receipt is skipped.
+        Receipt cost is added to cell. Note with full purchase list is added to selected cell.
+        :param receipt. Parsed receipt (Receipt) from email message.
+        :return nothing.
+        """
+        if not receipt.date == self.date:
+            return
+        self.__queue_cell(self.cell_and_number, receipt.cost, '\n'.join(receipt.items))
+        self.cell_and_number = self.__increase_cell_number(self.cell_and_number, 1)
+
+    def flush(self):
+        """
+        Sends all buffered receipts with one batchUpdate and saves sheet layout.
+        :return nothing.
+        """
+        written = len(self.requests) > 0
+        self.__flush()
+        # Own writes change revision too, so layout is saved with revision after them
+        if self.read_layout or written:
+            self.__save_layout()
+        self.cell_and_number = None
+
     def write_to_sheet(self, receipts):
         """
         Writes parsed receipts from messages to sheets api.
-        If receipt date do not match current date - receipt is skipped.
-        First cost written in receipt is added to cell. Note with full
-        purchase list is added to selected cell.
-        :param receipts. Founded receipts in first 30 email messages
+        Every receipt is added by add_receipt() method and all changes are sent with one batchUpdate.
+        :param receipts. Parsed receipts from email messages
         :return nothing.
         """
         self.log.debug('Writting to sheet ..')
-        self.__get_current_dates()
-        cell_range = self.__loop_through(self.service)  # Find week
-        cell_and_number = self.__increase_cell_number(cell_range, 2)  # Find start position
+        if self.cell_and_number is None:
+            self.prepare()
+        for receipt in receipts:
+            self.add_receipt(receipt)
+        self.flush()
 
+    def write_history(self, receipts):
+        """
+        Writes receipts of any dates (e.g backfill of whole year). Receipts are grouped
+        by month sheet and day cell, then all changes are sent with batchUpdate.
+        Receipts of the same day are written to consecutive cells below the day cell.
+        :param receipts. Parsed receipts (Receipt) from email messages.
+        :return nothing.
+        """
+        by_day = defaultdict(list)
         for receipt in receipts:
-            cost = []
-            if not receipt[0] == self.date:
+            by_day[receipt.date].append(receipt)
+        self.requests = list()
+        layouts = dict()
+        for month, days in groupby(sorted(by_day), key=lambda day: day[:7]):
+            self.month = month
+            try:
+                self.__load_layout()
+            except errors.HttpError as error:
+                self.log.warning(f'Could not read sheet {month}: {error}')
+                continue
+            if self.sheet_id is None:
+                self.log.warning(f'No sheet for {month}, skipping its receipts')
                 continue
-            for items in receipt[1:]:
-                if isinstance(items, list):
-                    startRowIndex, endRowIndex, startColumnIndex, endColumnIndex = self.__get_cell_range(cell_and_number)
-                    body = {
-                        "requests": [
-                            {
-                                "repeatCell": {
-                                    "range": {
-                                        "sheetId": self.__get_sheet_id(),  # this is the end bit of the url
-                                        "startRowIndex": startRowIndex,
-                                        "endRowIndex": endRowIndex,
-                                        "startColumnIndex": startColumnIndex,
-                                        "endColumnIndex": endColumnIndex,
-                                    },
-                                    "cell": {"note": '\n'.join(items)},
-                                    "fields": "note",
-                                }
-                            }
-                        ]
-                    }
-                    self.__update_sheet(body)
-                else:
-                    cost.append([items])
-                    body = {
-                       'values': cost
-                    }
-                    self.log.debug('Updating sheet .. ')
-                    self.__update_sheet(body, f'{self.month}!{cell_and_number}')
-            cell_and_number = self.__increase_cell_number(cell_and_number, 1)
+            layouts[month] = {'sheet_id': self.sheet_id, 'week_dates': self.week_dates, 'weeks': self.weeks}
+            for day in days:
+                self.date = day
+                cell = self.__loop_through()
+                if cell is None:
+                    self.log.warning(f'No cell for {day}, skipping its receipts')
+                    continue
+                cell = self.__increase_cell_number(cell, 2)
+                for receipt in by_day[day]:
+                    self.__queue_cell(cell, receipt.cost, '\n'.join(receipt.items))
+                    cell = self.__increase_cell_number(cell, 1)
+        self.log.info(f'Writing {len(self.requests)} receipts of {len(layouts)} months')
+        self.__flush()
+        revision = self.__get_revision()
+        for month, layout in layouts.items():
+            self.layout_index.put(self.spreadsheet_id, month, revision, layout)
+        self.__get_current_dates()
@@ -0,0 +1,58 @@
+import json
+import base64
+import tracemalloc
+from datetime import date
+import pytest
+
+pytest.importorskip('googleapiclient')
+
+from fake_google import FakeGoogleProcess, synthetic_message
+from gmail_api import GmailApi
+from google_clients import ClientManager
+from receipt_parser import parse_raw_message
+from request_executor import RequestExecutor
+
+
+def stream_peaks(size):
+    """
+    Streams every receipt of stand-in mailbox through GmailApi.iter_receipts with traced memory,
+    first with empty receipt cache and then again (sync state is not committed) with warm cache.
+    Stand-in Google APIs run in separate process, so only client memory is traced.
+    :param size. Number of receipt messages in mailbox.
+    :return list. Tuples of number of receipts and peak traced memory in bytes of cold and warm pass.
+    """
+    server = FakeGoogleProcess(size)
+    try:
+        unlimited = {api: (1e9, 1e9) for api in RequestExecutor.QUOTAS}
+        clients = ClientManager(executor=RequestExecutor(quotas=unlimited), root_url=server.url)
+        passes = list()
+        for _ in range(2):
+            gmail = GmailApi(clients=clients)
+            tracemalloc.start()
+            try:
+                receipts = sum(1 for _ in gmail.iter_receipts())
+                passes.append((receipts, tracemalloc.get_traced_memory()[1]))
+            finally:
+                tracemalloc.stop()
+        return passes
+    finally:
+        server.stop()
+
+
+def test_iter_receipts_memory_is_flat(tmp_path, monkeypatch):
+    small, large = 30, 2000
+    tmp_path.joinpath('small').mkdir()
+    monkeypatch.chdir(tmp_path.joinpath('small'))
+    (small_cold, small_cold_peak), (small_warm, small_warm_peak) = stream_peaks(small)
+    tmp_path.joinpath('large').mkdir()
+    monkeypatch.chdir(tmp_path.joinpath('large'))
+    (large_cold, large_cold_peak), (large_warm, large_warm_peak) = stream_peaks(large)
+    message = synthetic_message('m0', date(2019, 1, 1))
+    raw_size = len(base64.urlsafe_b64decode(message['raw']))
+    receipt_size = len(json.dumps(parse_raw_message(message, GmailApi.SENDER)))
+
+    assert (small_cold, small_warm, large_cold, large_warm) == (small, small, large, large)
+    # Only message ids and not yet collected garbage may grow, raw messages must not be kept
+    assert (large_cold_peak - small_cold_peak) / (large - small) < raw_size
+    # Cached receipts are loaded batch by batch, not for every listed message up front
+    assert (large_warm_peak - small_warm_peak) / (large - small) < receipt_size